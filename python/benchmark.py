@@ -0,0 +1,52 @@
+import timeit
+import numpy as np
+from cnn.layers import *
+
+# --------------------------------------
+# Reference-model micro benchmarks
+# --------------------------------------
+X_DIM = 64
+Y_DIM = 64
+IN_FMAPS = 32
+NUM_FILTERS = 32
+REPEATS = 5
+
+
+def best_of(func, repeats=REPEATS):
+    return min(timeit.repeat(func, number=1, repeat=repeats))
+
+
+def bench_winograd(fixed=None):
+    """ conv3x3_S1_P1 with int8 weights: Winograd against the im2col GEMM. """
+    inputs = np.random.randint(0, 255, size=(1, IN_FMAPS, Y_DIM, X_DIM))
+    ref = Conv((IN_FMAPS, Y_DIM, X_DIM), NUM_FILTERS, 3, 3, stride=1, padding=1, fixed=fixed, engine='im2col')
+    wino = Conv((IN_FMAPS, Y_DIM, X_DIM), NUM_FILTERS, 3, 3, stride=1, padding=1, fixed=fixed, engine='winograd')
+    wino.W = ref.W = np.random.randint(-128, 128, size=ref.W.shape).astype(np.int8)
+
+    for X in (inputs, inputs.astype('float64')):
+        if not np.array_equal(ref.forward(X), wino.forward(X)):
+            raise AssertionError("Winograd result differs from im2col ({})".format(X.dtype))
+        t_ref = best_of(lambda: ref.forward(X))
+        t_wino = best_of(lambda: wino.forward(X))
+        print("conv3x3_S1_P1 {}x{}x{} -> {} {:>8}: im2col {:8.2f} ms  winograd {:8.2f} ms  speedup {:5.2f}x".format(
+            X_DIM, Y_DIM, IN_FMAPS, NUM_FILTERS, str(X.dtype), t_ref * 1e3, t_wino * 1e3, t_ref / t_wino))
+
+
+def bench_col2im(batch=8):
+    """ np.add.at reference against the bincount and strided-slice col2im. """
+    x_shape = (batch, IN_FMAPS, Y_DIM, X_DIM)
+    cols = np.random.randint(-128, 128, size=(IN_FMAPS * 9, X_DIM * Y_DIM * batch))
+    ref = col2im_indices(cols, x_shape)
+    timings = [('add.at', best_of(lambda: col2im_indices(cols, x_shape)))]
+    for name, func in (('bincount', col2im_bincount), ('strided', col2im_strided)):
+        if not np.array_equal(ref, func(cols, x_shape)):
+            raise AssertionError("col2im_{} result differs from col2im_indices".format(name))
+        timings.append((name, best_of(lambda: func(cols, x_shape))))
+    print("col2im {}x{}x{}x{}: ".format(*x_shape) + "  ".join(
+        "{} {:8.2f} ms".format(name, t * 1e3) for name, t in timings))
+
+
+if __name__ == '__main__':
+    bench_winograd()
+    bench_winograd(FixedPoint(32, 8))
+    bench_col2im()
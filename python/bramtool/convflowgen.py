@@ -1,6 +1,82 @@
+import os
 import numpy as np
 import math
+from collections import deque
+from functools import lru_cache
+from multiprocessing import Pool
 from PIL import Image
+from .hexfile import write_hex
+
+# Number of distinct dataflow layouts kept alive.
+DATAFLOW_PLAN_CACHE_SIZE = 32
+
+
+@lru_cache(maxsize=DATAFLOW_PLAN_CACHE_SIZE)
+def dataflow_plan(rows, columns, kernel_size, stride, padding_size, pox, poy):
+    """ Gather indices of the BRAM dataflow of an unpadded (rows, columns) fmap.
+
+        Index rows*columns denotes a zero (padding or void position). The
+        result has the shape (boxes*subrows, poy, per_write_rows, pox) with
+        the macro-boxes ordered x_load major, as written into the data BRAM.
+        Shared and read-only.
+    """
+    num_loads_y = math.floor(rows / (poy*stride))
+    num_loads_x = math.floor(columns / (pox*stride))
+
+    if kernel_size - stride >= 0:
+        ord_rows = kernel_size - stride
+        strided_rows = stride
+    else:
+        ord_rows = 0
+        strided_rows = kernel_size
+
+    num_dfrows = poy*stride + ord_rows
+    num_dfcols = pox + kernel_size - 1
+    per_write_rows = math.ceil(num_dfcols / pox)
+    zero = rows * columns
+
+    # Source row/column of every frame position per load, -1 outside the
+    # frame. Only rows are padded, columns of the frame may be cut off.
+    padded_rows = np.full(rows + 2*padding_size, -1)
+    padded_rows[padding_size:padding_size+rows] = np.arange(rows)
+    frame_rows = np.full((num_loads_y, num_dfrows + 1), -1)
+    for y_load in range(num_loads_y):
+        y_pos = y_load * poy * stride
+        src = padded_rows[y_pos:y_pos+num_dfrows]
+        frame_rows[y_load, :len(src)] = src
+
+    frame_cols = np.full((num_loads_x, num_dfcols), -1)
+    for x_load in range(num_loads_x):
+        if x_load > 0:
+            x_pos = x_load * pox * stride - padding_size*stride
+        else:
+            x_pos = 0
+        src = np.arange(columns)[x_pos:x_pos+num_dfcols]
+        frame_cols[x_load, :len(src)] = src
+    # Each frame row is repeated cyclically over per_write_rows words
+    frame_cols = frame_cols[:, np.arange(per_write_rows * pox) % num_dfcols]
+
+    # Dataflow rows as picked from the frame, num_dfrows is the zero row
+    ydx = np.arange(poy)
+    strided = np.arange(strided_rows)[:, None] + ydx * stride
+    ordinary = poy * (strided_rows + np.arange(math.ceil(ord_rows / poy)))[:, None] + ydx
+    subrows = np.vstack((strided, np.minimum(ordinary, num_dfrows)))
+
+    row_src = frame_rows[:, subrows]                    # (y_load, sub, poy)
+    row_src = row_src[None, :, :, :, None]
+    col_src = frame_cols[:, None, None, None, :]        # (x_load, ..., words)
+    plan = np.where((row_src >= 0) & (col_src >= 0), row_src * columns + col_src, zero)
+    plan = plan.reshape(-1, poy, per_write_rows, pox)
+    plan.setflags(write=False)
+    return plan
+
+
+def _convert_image(task):
+    """ Pool worker: dataflow of one image into its own BRAM file. """
+    config, inputs, args = task
+    Convflowgen(*config).convert(inputs, *args)
+    return config[5]
+
 
 class Convflowgen:
     def __init__(self, pox, poy, pof, data_width, weight_width, data_path, kernel_path):
@@ -13,22 +89,51 @@ class Convflowgen:
         self.path_kbram = kernel_path
 
     def convert(self, inputs, kernel_size, stride, padding_size, itype='array', otype='dec'):
-        dflow = []
         if itype == 'text':
-            for txt_path in inputs: 
-                pixels = np.loadtxt(txt_path)
-                dflow.extend(self.generate_dataflow(pixels, kernel_size, stride, padding_size))
+            fmaps = [np.loadtxt(txt_path) for txt_path in inputs]
         elif itype == 'array':
-            for pixels in inputs: 
-                dflow.extend(self.generate_dataflow(pixels, kernel_size, stride, padding_size))
+            fmaps = list(inputs)
         elif itype == 'image':
-            for img_path in inputs: 
-                im = Image.open(img_path).convert("L")
-                pixels = np.array(im)
-                dflow.extend(self.generate_dataflow(pixels, kernel_size, stride, padding_size))
+            fmaps = [np.array(Image.open(img_path).convert("L")) for img_path in inputs]
         else:
             raise TypeError
-        self.write_dataflow(dflow, otype)    
+        # Equally sized fmaps go through the gather plan in one go
+        if len({np.shape(pixels) for pixels in fmaps}) == 1:
+            dflow = self.generate_dataflow(np.stack(fmaps), kernel_size, stride, padding_size)
+        else:
+            dflow = [d for pixels in fmaps
+                     for d in self.generate_dataflow(pixels, kernel_size, stride, padding_size)]
+        self.write_dataflow(dflow, otype)
+
+    def convert_batch(self, images, kernel_size, stride, padding_size, itype='array', otype='hex',
+                      path_pattern=None, workers=None):
+        """ Dataflow of many images in a process pool, one data BRAM file each.
+            At most two images per worker are in flight, so memory does not
+            grow with the number of images. Returns the written paths in order.
+                @images       - iterable of images, each one convert() input list
+                                (fmap arrays, text or image paths)
+                @path_pattern - file path with {} for the image index, defaults
+                                to the data BRAM path with _<index> before the extension
+                @workers      - number of processes, defaults to the cpu count
+        """
+        if path_pattern is None:
+            root, ext = os.path.splitext(self.path_dbram)
+            path_pattern = root + '_{}' + ext
+        workers = workers or os.cpu_count()
+        args = (kernel_size, stride, padding_size, itype, otype)
+
+        paths = []
+        with Pool(workers) as pool:
+            pending = deque()
+            for index, inputs in enumerate(images):
+                config = (self.pox, self.poy, self.pof, self.data_width, self.weight_width,
+                          path_pattern.format(index), self.path_kbram)
+                pending.append(pool.apply_async(_convert_image, ((config, inputs, args),)))
+                if len(pending) >= 2 * workers:
+                    paths.append(pending.popleft().get())
+            while pending:
+                paths.append(pending.popleft().get())
+        return paths
 
     @staticmethod
     def add_margin(pix, top_padding, down_padding):
@@ -42,19 +147,22 @@ class Convflowgen:
     def write_dataflow(self, data, mode='hex'):
         """ Dump data from internal BRAM representation into file.
         """
-        to_hex = lambda x : hex(x & 0xff)[2:]
         with open(self.path_dbram,'w') as f:
             f.truncate(0)
 
+            if mode=='hex':
+                if len(data):
+                    # (words, poy, per_write_rows, pox) -> one line per write row
+                    data = np.asarray(data)
+                    lines = data.transpose(0, 2, 1, 3).reshape(-1, data.shape[1] * data.shape[3])
+                    write_hex(f, lines, self.data_width // 4)
+                return
+
             for d in data:
                 temp  = np.concatenate(d, axis=1)
-                if mode=='hex':
-                    temp = np.array([[to_hex(int(e)).zfill(self.data_width // 4) for e in d] for d in temp])
-                    np.savetxt(f, temp, fmt="%s", delimiter='')
-                else:
-                    temp = np.array([[int(e) for e in d] for d in temp])
-                    np.savetxt(f, temp, fmt="%3s", delimiter=' ')
-                    f.write("\n")
+                temp = np.array([[int(e) for e in d] for d in temp])
+                np.savetxt(f, temp, fmt="%3s", delimiter=' ')
+                f.write("\n")
 
     def get_dfsubindexing(self, stride, strided_rows, ordinary_rows, length_limit):
         indizes = []
@@ -78,71 +186,21 @@ class Convflowgen:
         return indizes
   
     def generate_dataflow(self, pix, kernel_size, stride, padding_size):
-        """ Converts an image to a BRAM dataflow representation. 
-            Store result inside an internal array-based buffer.
-                @img_path - path to the .jpg file to convert
+        """ Converts an image to a BRAM dataflow representation.
+            Returns an array of (poy, per_write_rows, pox) dataflow words.
+                @pix - fmap (rows, cols) or a stack of equally sized fmaps
+                       (fmaps, rows, cols), concatenated in fmap order
         """
-        # Add padding to the input. Get input dimensions.
-        rows    = pix.shape[0]
-        columns = pix.shape[1]
-        pix     = Convflowgen.add_margin(pix, padding_size, padding_size)
-
-        # Rows and columns are processed in parallel.
-        # Calculate number of data accesses. Divide total rows, cols by parallelism.
-        num_loads_y = math.floor(rows / (self.poy*stride))
-        num_loads_x = math.floor(columns / (self.pox*stride))
-        x_pos = 0
-        y_pos = 0
-
-        # Calculate the number of rows and columns needed to be exctracted from fmap.
-        # Based on stride and kernel_size
-        
-        if kernel_size - stride >= 0:
-            ord_rows = kernel_size - stride
-            strided_rows = stride
-        else:
-            ord_rows = 0
-            strided_rows = kernel_size
+        pix = np.asarray(pix, dtype=np.float64)
+        fmaps = pix.reshape((-1,) + pix.shape[-2:])
+        rows, columns = fmaps.shape[1:]
+        plan = dataflow_plan(rows, columns, kernel_size, stride, padding_size, self.pox, self.poy)
 
-        num_dfrows = self.poy*stride + ord_rows
-        num_dfcols = self.pox + kernel_size - 1
-
-        per_write_rows = math.ceil(num_dfcols / self.pox)
-        per_write_cols = self.pox
-        
-        # Iterate over the fmap macro-boxes
-        # Jumps in x and y directions result from parallelism Pox and Poy
-        result = []
-        for x_load in range(num_loads_x):
-            for y_load in range(num_loads_y):
-
-                # Calculate y_pos, x_pos of current macro-box
-                y_pos = y_load * self.poy * stride
-                if x_load > 0: 
-                    x_pos = x_load * (self.pox ) * stride - padding_size*stride
-                else:
-                    x_pos = x_load * self.pox * stride
-
-                # Extract current part of fmap and fill void positions with zeros
-                buffer = np.zeros((num_dfrows, num_dfcols))
-                frame = pix[y_pos:y_pos+num_dfrows, x_pos:x_pos+num_dfcols]
-                for idx, row in enumerate(frame):
-                    for jdx, elem in enumerate(row):
-                        buffer[idx, jdx] = elem
-
-                # Get indizes for buffer subindexing to obtain a valid represenetation of the dataflow
-                indizes = self.get_dfsubindexing(stride, strided_rows, math.ceil(ord_rows/self.poy), len(buffer))
-                indizes = np.reshape(indizes, (strided_rows + math.ceil(ord_rows/self.poy), self.poy))
-
-                buffer = [np.resize(row, (per_write_rows, self.pox)) for row in buffer]
-                buffer.append(np.zeros((per_write_rows, self.pox))) # Append zero buffer at the end do make subindexing easy
-                buffer = np.array(buffer)
-                
-                dflow = buffer[indizes]
-
-                result.extend(dflow)
-
-        return result
+        # Flat fmaps with a trailing zero, the target of every void position
+        flat = np.zeros((len(fmaps), rows * columns + 1))
+        flat[:, :-1] = fmaps.reshape(len(fmaps), -1)
+        dflow = np.take(flat, plan, axis=1)
+        return dflow.reshape((-1,) + plan.shape[1:])
 
     def write_conv_kernels(self, kernels):
         num_kernels, num_fmaps, kernel_height, kernel_width = kernels.shape
@@ -151,9 +209,7 @@ class Convflowgen:
         kernels = np.array([np.hstack(kernels)])
         kernels = np.transpose(kernels,(0,2,1))
 
-        to_hex = lambda x : hex(x & 0xff)[2:] # Remove the leading 0x
         with open(self.path_kbram,'ab') as f:
             f.truncate(0)
             for k in kernels:
-                temp = np.array([[to_hex(e).zfill(self.weight_width // 4) for e in r] for r in k])
-                np.savetxt(f, temp, fmt="%s", delimiter='')
\ No newline at end of file
+                write_hex(f, k, self.weight_width // 4)
\ No newline at end of file
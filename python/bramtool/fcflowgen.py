@@ -1,6 +1,7 @@
 import numpy as np
 import math
 from PIL import Image
+from .hexfile import CHUNK_LINES, write_hex
 
 class Fcflowgen:
     def __init__(self, pox, poy, pof, data_width, weight_width, path_data, path_kernels):
@@ -12,30 +13,53 @@ class Fcflowgen:
         self.path_dbram = path_data
         self.path_kbram = path_kernels
 
-    def convert(self, i_data, flatdim, tilelines):
-        data = np.resize(i_data, (tilelines, self.pox*self.poy))
-        to_hex = lambda x : hex(x & 0xff)[2:]
+    def convert(self, i_data, flatdim, tilelines, chunk_lines=CHUNK_LINES):
+        """ Write the flattened input as tilelines lines of pox*poy words. """
         with open(self.path_dbram,'ab') as f:
             f.truncate(0)
-            temp = np.array([[to_hex(e).zfill(self.data_width // 4) for e in d] for d in data])
-            np.savetxt(f, temp, fmt="%s", delimiter='')        
+            for chunk in self.data_chunks(i_data, flatdim, tilelines, chunk_lines):
+                write_hex(f, chunk, self.data_width // 4)
 
-    def write_fc_kernels(self, kernels, num_kernels, kernel_flatdim):
-
-        
-        # kernels = np.transpose(kernels)
-        # print(kernels)
-
-        kernels = np.array(np.hsplit(kernels, num_kernels/self.pof))
-
-        kernels = kernels.reshape((num_kernels//self.pof *  kernel_flatdim, self.pof))
-       
-        print(kernels)
-        
-        to_hex = lambda x : hex(x & 0xff)[2:]
+    def write_fc_kernels(self, kernels, num_kernels, kernel_flatdim, chunk_lines=CHUNK_LINES):
+        """ Write the (flatdim, num_kernels) weights group by group of pof
+            kernels, kernel_flatdim lines of pof words per group.
+        """
         with open(self.path_kbram,'ab') as f:
             f.truncate(0)
-            temp = np.array([[to_hex(e).zfill(self.weight_width // 4) for e in r] for r in kernels])
-            np.savetxt(f, temp, fmt="%s", delimiter='')
-                
-                   
\ No newline at end of file
+            for chunk in self.kernel_chunks(kernels, num_kernels, kernel_flatdim, chunk_lines):
+                write_hex(f, chunk, self.weight_width // 4)
+
+    def data_chunks(self, i_data, flatdim, tilelines, chunk_lines=CHUNK_LINES):
+        """ Generator of (lines, pox*poy) blocks of the data BRAM, at most
+            chunk_lines each. The first flatdim values are used, the rest of
+            the last line is zero padded.
+        """
+        words = self.pox * self.poy
+        flat = np.ravel(i_data)[:flatdim]
+        if len(flat) > tilelines * words:
+            raise ValueError("{} values do not fit into {} lines of {} words".format(
+                len(flat), tilelines, words))
+        for start in range(0, tilelines, chunk_lines):
+            lines = min(chunk_lines, tilelines - start)
+            chunk = np.zeros(lines * words, dtype=flat.dtype)
+            values = flat[start * words:(start + lines) * words]
+            chunk[:len(values)] = values
+            yield chunk.reshape(lines, words)
+
+    def kernel_chunks(self, kernels, num_kernels, kernel_flatdim, chunk_lines=CHUNK_LINES):
+        """ Generator of (lines, pof) blocks of the kernel BRAM, at most
+            chunk_lines each. A last group of less than pof kernels and
+            kernels shorter than kernel_flatdim are zero padded.
+        """
+        flatdim = kernels.shape[0]
+        if flatdim > kernel_flatdim or kernels.shape[1] != num_kernels:
+            raise ValueError("({}, {}) kernels do not fit {} kernels of {} lines".format(
+                flatdim, kernels.shape[1], num_kernels, kernel_flatdim))
+        for group in range(0, num_kernels, self.pof):
+            columns = kernels[:, group:group + self.pof]
+            for start in range(0, kernel_flatdim, chunk_lines):
+                lines = min(chunk_lines, kernel_flatdim - start)
+                chunk = np.zeros((lines, self.pof), dtype=kernels.dtype)
+                values = columns[start:start + lines]
+                chunk[:len(values), :values.shape[1]] = values
+                yield chunk
@@ -0,0 +1,155 @@
+import os
+import tempfile
+import time
+import numpy as np
+from .convflowgen import Convflowgen
+from .hexfile import read_hex
+
+# Values pass the BRAM writers masked to their low byte
+WORD_MASK = 0xff
+
+
+class Flowreader:
+    """ Inverse of Convflowgen: BRAM input files back to fmaps and kernels.
+        Values come back as the writers stored them, masked to WORD_MASK.
+    """
+
+    def __init__(self, pox, poy, pof, data_width, weight_width, data_path, kernel_path):
+        self.pox = pox
+        self.poy = poy
+        self.pof = pof
+        self.data_width = data_width
+        self.weight_width = weight_width
+        self.path_dbram = data_path
+        self.path_kbram = kernel_path
+
+    def read_dataflow(self, rows, cols, kernel_size, stride, padding_size):
+        """ Reconstruct the padded (fmaps, rows+2*padding, cols) fmaps from the
+            data BRAM file. Every word is checked against the layout: copies of
+            a pixel must agree and void or padding words must be zero.
+            Returns the fmaps and the mask of pixels the dataflow covers.
+
+            Decoded from the BRAM layout rules, not from the gather plan the
+            writer uses: macro-boxes x_load major, each a frame of the row
+            padded fmap at (y_load*poy*stride, x_load*pox*stride, shifted back
+            by padding*stride after the first column), written as strided
+            sub-rows s + ydx*stride followed by ordinary sub-rows
+            poy*(strided_rows+o) + ydx, every frame row repeated cyclically
+            over the pox words of a write row.
+        """
+        poy, pox = self.poy, self.pox
+        num_loads_y = rows // (poy*stride)
+        num_loads_x = cols // (pox*stride)
+        if kernel_size - stride >= 0:
+            ord_rows, strided_rows = kernel_size - stride, stride
+        else:
+            ord_rows, strided_rows = 0, kernel_size
+        num_dfrows = poy*stride + ord_rows
+        num_dfcols = pox + kernel_size - 1
+        per_write_rows = -(-num_dfcols // pox)
+        subrows = [[s + ydx*stride for ydx in range(poy)] for s in range(strided_rows)]
+        subrows += [[poy*(strided_rows+o) + ydx for ydx in range(poy)]
+                    for o in range(-(-ord_rows // poy))]
+        lines_per_fmap = num_loads_x * num_loads_y * len(subrows) * per_write_rows
+
+        words = read_hex(self.path_dbram, self.data_width // 4)
+        if lines_per_fmap == 0 or words.size == 0:
+            raise ValueError("{}: no dataflow for {}x{}".format(self.path_dbram, rows, cols))
+        if words.shape[1] != poy * pox or len(words) % lines_per_fmap:
+            raise ValueError("{}: {} lines of {} words do not match the layout".format(
+                self.path_dbram, len(words), words.shape[1]))
+        fmaps = len(words) // lines_per_fmap
+        # Write rows (per_write_rows, poy, pox) back to poy frame rows of per_write_rows*pox words
+        words = words.reshape(fmaps, num_loads_x, num_loads_y, len(subrows), per_write_rows, poy, pox)
+        words = words.transpose(0, 1, 2, 3, 5, 4, 6).reshape(
+            fmaps, num_loads_x, num_loads_y, len(subrows), poy, per_write_rows * pox)
+
+        height = rows + 2*padding_size
+        padded = np.zeros((fmaps, height, cols), dtype=np.int64)
+        written = np.zeros((height, cols), dtype=bool)
+        word_cols = np.arange(per_write_rows * pox) % num_dfcols
+        for x_load in range(num_loads_x):
+            x_pos = x_load*pox*stride - padding_size*stride if x_load > 0 else 0
+            # Columns are not padded, the frame is cut off at the fmap border
+            frame_cols = np.arange(cols)[x_pos:x_pos+num_dfcols]
+            valid = word_cols < len(frame_cols)
+            xs = frame_cols[word_cols[valid]]
+            for y_load in range(num_loads_y):
+                frame_rows = np.arange(height)[y_load*poy*stride:y_load*poy*stride+num_dfrows]
+                for sub, rows_of_sub in enumerate(subrows):
+                    for ydx, frame_row in enumerate(rows_of_sub):
+                        word = words[:, x_load, y_load, sub, ydx]
+                        if frame_row >= len(frame_rows):
+                            void = word
+                        else:
+                            y, void = frame_rows[frame_row], word[:, ~valid]
+                            new = ~written[y, xs]
+                            padded[:, y, xs[new]] = word[:, valid][:, new]
+                            written[y, xs] = True
+                            if not np.array_equal(padded[:, y, xs], word[:, valid]):
+                                raise ValueError("{}: copies of row {} disagree in box ({}, {})".format(
+                                    self.path_dbram, y, x_load, y_load))
+                        if void.any():
+                            raise ValueError("{}: nonzero void words in box ({}, {})".format(
+                                self.path_dbram, x_load, y_load))
+
+        if padded[:, :padding_size].any() or padded[:, padding_size+rows:].any():
+            raise ValueError("{}: nonzero padding rows".format(self.path_dbram))
+        return padded, written[padding_size:padding_size+rows]
+
+    def read_conv_kernels(self, num_kernels, kernel_size):
+        """ Reconstruct the (num_kernels, fmaps, kernel_size, kernel_size)
+            kernels from the kernel BRAM file, inverse of write_conv_kernels.
+        """
+        lines = read_hex(self.path_kbram, self.weight_width // 4)
+        if lines.shape[1] != self.pof or len(lines) % (num_kernels // self.pof * kernel_size**2):
+            raise ValueError("{}: {} lines of {} words do not match {} kernels".format(
+                self.path_kbram, len(lines), lines.shape[1], num_kernels))
+        # (groups*fmaps*k*k, pof) -> (groups, pof, fmaps*k*k)
+        kernels = lines.T.reshape(self.pof, num_kernels // self.pof, -1).transpose(1, 0, 2)
+        return kernels.reshape(num_kernels, -1, kernel_size, kernel_size)
+
+
+def check_roundtrip(trials=1000, seed=None, path=None):
+    """ Encode random fmaps and kernels with Convflowgen over randomized
+        shapes and parallelism, decode them again and compare.
+        Raises AssertionError on the first mismatch, returns the trial count.
+    """
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory(dir=path) as tmp:
+        data_path, kernel_path = os.path.join(tmp, 'bram.txt'), os.path.join(tmp, 'kernels.txt')
+        for trial in range(trials):
+            pox, poy, pof = (int(v) for v in rng.integers(1, 9, size=3))
+            kernel_size = int(rng.integers(1, 6))
+            stride = int(rng.integers(1, 3))
+            padding_size = int(rng.integers(0, kernel_size // 2 + 1))
+            # Not only whole macro-boxes: cut-off frames and uncovered borders
+            rows = int(rng.integers(1, 5)) * poy * stride + int(rng.integers(0, poy * stride))
+            cols = int(rng.integers(1, 5)) * pox * stride + int(rng.integers(0, pox * stride))
+            data_width, weight_width = (int(v) for v in rng.choice([8, 16, 32], size=2))
+            num_fmaps = int(rng.integers(1, 4))
+            num_kernels = pof * int(rng.integers(1, 4))
+            config = (pox, poy, pof, data_width, weight_width, data_path, kernel_path)
+
+            fmaps = rng.integers(-128, 256, size=(num_fmaps, rows, cols))
+            kernels = rng.integers(-128, 128, size=(num_kernels, num_fmaps, kernel_size, kernel_size))
+            generator = Convflowgen(*config)
+            generator.convert(list(fmaps), kernel_size, stride, padding_size, otype='hex')
+            generator.write_conv_kernels(kernels)
+
+            reader = Flowreader(*config)
+            padded, covered = reader.read_dataflow(rows, cols, kernel_size, stride, padding_size)
+            inner = padded[:, padding_size:padding_size + rows]
+            if not np.array_equal(inner[:, covered], fmaps[:, covered] & WORD_MASK):
+                raise AssertionError("Dataflow round trip failed: {} {}x{}x{} k={} s={} p={}".format(
+                    config[:3], num_fmaps, rows, cols, kernel_size, stride, padding_size))
+            if not np.array_equal(reader.read_conv_kernels(num_kernels, kernel_size), kernels & WORD_MASK):
+                raise AssertionError("Kernel round trip failed: {} {} kernels of {}x{}x{}".format(
+                    config[:3], num_kernels, num_fmaps, kernel_size, kernel_size))
+    return trials
+
+
+if __name__ == '__main__':
+    t_start = time.perf_counter()
+    trials = check_roundtrip()
+    print("{} dataflow round trips in {:.2f} s".format(trials, time.perf_counter() - t_start))
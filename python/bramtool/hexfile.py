@@ -0,0 +1,111 @@
+import io
+import os
+import numpy as np
+from functools import lru_cache
+
+# Lines encoded per write, bounds the temporary text buffer.
+CHUNK_LINES = 1 << 16
+
+# Longest line looked at to find the fixed line width
+MAX_LINE_BYTES = 1 << 16
+
+# Nibble value of every ASCII hex digit, -1 for anything else
+NIBBLES = np.full(256, -1, dtype=np.int64)
+for _digit in b'0123456789abcdef':
+    NIBBLES[_digit] = NIBBLES[ord(chr(_digit).upper())] = int(chr(_digit), 16)
+
+# Widest mask encoded through a per-value lookup table (64k entries),
+# wider masks are encoded per byte
+TABLE_MASK = 0xffff
+
+# Two ASCII hex digits of every byte value
+BYTE_DIGITS = np.frombuffer(b''.join(b'%02x' % value for value in range(256)), dtype=np.uint8).reshape(256, 2)
+
+
+@lru_cache(maxsize=None)
+def hex_table(digits, mask=0xff):
+    """ Lookup table of the hex text of every masked value, mask <= TABLE_MASK.
+        Entries are hex(value)[2:].zfill(digits) as the testbench reads them,
+        entries shorter than the widest one are padded with NUL bytes.
+    """
+    if mask > TABLE_MASK:
+        raise ValueError("No lookup table for masks wider than {:#x}".format(TABLE_MASK))
+    words = [hex(value)[2:].zfill(digits) for value in range(mask + 1)]
+    table = np.array(words, dtype='S{}'.format(max(len(word) for word in words)))
+    table.setflags(write=False)
+    return table
+
+
+def encode_hex(values, digits, mask=0xff):
+    """ Hex text of a 2d array, one line per row without delimiters.
+            @digits - minimum number of hex digits per value (zero filled)
+            @mask   - values are masked with it (two's complement) first,
+                      any width up to 64 bits
+    """
+    # Truncates floats towards zero like int(), widens small ints for the mask
+    values = np.asarray(values).astype(np.int64, copy=False)
+    if mask > TABLE_MASK:
+        return _encode_bytes(values, digits, mask)
+    table = hex_table(digits, mask)
+    lines = np.empty((values.shape[0], values.shape[1] + 1), dtype=table.dtype)
+    np.take(table, values & mask, out=lines[:, :-1])
+    lines[:, -1] = b'\n'
+    text = lines.tobytes()
+    if table.itemsize > 1:
+        # Drop the padding of short entries and the newline column
+        text = text.replace(b'\0', b'')
+    return text
+
+
+def _encode_bytes(values, digits, mask):
+    # encode_hex without a table: big-endian bytes of the masked values
+    # (the uint64 view is the two's complement), two digits per byte
+    values = values.view(np.uint64) & np.uint64(mask)
+    fill = max(digits, 1)
+    width = max(fill, (int(mask).bit_length() + 3) // 4)
+    nbytes = (width + 1) // 2
+    octets = values.astype('>u8').view(np.uint8).reshape(values.shape + (8,))[:, :, 8 - nbytes:]
+    chars = BYTE_DIGITS[octets].reshape(values.shape + (2 * nbytes,))[:, :, 2 * nbytes - width:]
+    if width > fill:
+        # Leading zeros beyond the zero fill are not printed by hex()
+        lead = chars[:, :, :width - fill]
+        lead[np.logical_and.accumulate(lead == ord('0'), axis=2)] = 0
+    lines = np.empty((values.shape[0], values.shape[1] * width + 1), dtype=np.uint8)
+    lines[:, :-1] = chars.reshape(lines.shape[0], lines.shape[1] - 1)
+    lines[:, -1] = ord('\n')
+    text = lines.tobytes()
+    return text.replace(b'\0', b'') if width > fill else text
+
+
+def write_hex(f, values, digits, mask=0xff, chunk_lines=CHUNK_LINES):
+    """ Write a 2d array as hex text lines into the open file f.
+        Text mode files get str, so newlines are translated like np.savetxt.
+    """
+    values = np.asarray(values)
+    text_mode = isinstance(f, io.TextIOBase)
+    for start in range(0, len(values), chunk_lines):
+        text = encode_hex(values[start:start + chunk_lines], digits, mask)
+        f.write(text.decode('ascii') if text_mode else text)
+
+
+def read_hex(file_path, digits):
+    """ Read a file of fixed-width hex lines as written by write_hex into a
+        (lines, words) int64 array of the unsigned words.
+    """
+    if os.path.getsize(file_path) == 0:
+        return np.zeros((0, 0), dtype=np.int64)
+    raw = np.memmap(file_path, dtype=np.uint8, mode='r')
+    breaks = np.flatnonzero(raw[:MAX_LINE_BYTES] == ord('\n'))
+    width = int(breaks[0]) + 1 if len(breaks) else raw.size
+    words = len(bytes(raw[:width]).rstrip(b'\r\n')) // digits
+    if raw.size % width:
+        raise ValueError("{}: lines are not {} bytes wide".format(file_path, width))
+    chars = raw.reshape(-1, width)[:, :words * digits].reshape(-1, words, digits)
+    nibbles = NIBBLES[chars]
+    if (nibbles < 0).any():
+        raise ValueError("{}: no hex digits".format(file_path))
+    values = np.zeros(nibbles.shape[:2], dtype=np.int64)
+    for k in range(digits):
+        values <<= 4
+        values |= nibbles[:, :, k]
+    return values
@@ -1,7 +1,8 @@
+import os
 import numpy as np
 from PIL import Image
-from itertools import islice
-from textwrap import wrap
+from .hexfile import MAX_LINE_BYTES, NIBBLES
+
 
 class OutputReader:
 
@@ -29,75 +30,108 @@ class OutputReader:
         return value        
     
     def read(self, rows, cols, tile_iterations, pooling=False, save_img=False):
+        """ Read all output buffers into an (iterations, fmaps, rows, cols)
+            int64 array. Fmaps are ordered output1 first.
+        """
+        if pooling:
+            rows, cols = rows // 2, cols // 2
+        if rows == 0 or cols == 0:
+            return np.zeros((tile_iterations, self.num_buffers * self.fmaps_per_buffer, rows, cols), dtype=np.int64)
         result = []
         for i in range(self.num_buffers):
             file_path = self.base_path + "output" + str(i+1) + ".txt"
-            x = self.read_outbuffer(file_path,tile_iterations)
-            result.append(x)
-        x = self.outputbrams2fmaps(result, rows, cols, tile_iterations, pooling, save_img)
-        return x
+            result.append(self.read_outbuffer(file_path, rows, cols, tile_iterations))
+        return self.outputbrams2fmaps(result, save_img)
 
-
-    def read_outbuffer(self, file_path, tile_iterations):
-        """ Reads a dataflow dump in text-based format. 
-            Store the data into the internal BRAM representation
+    def decode_lines(self, file_path):
+        """ Memory-map a dump of fixed-width hex lines and decode it.
+            Returns the (lines, words) values, sign extended at data_width, and
+            a mask of the words that decode. A word that does not (X, U, ...)
+            ends its line, as with the testbench's partial writes.
         """
-        lines_per_iteration = 0
-        with open(file_path, 'r') as f:
-            number_of_lines =  sum(1 for _ in f)
-            lines_per_iteration = number_of_lines // tile_iterations
-        
-        iterations = []
-        with open(file_path, 'r') as f:
-            for i in range(tile_iterations):
-                iter_buffer = [[] for fmap in range(self.fmaps_per_buffer)]
-                lines_read = 0
-                block_index = 0
-                while lines_read < lines_per_iteration:
-                    next_n_lines = list(islice(f, self.poy))
-                    xline = [wrap(item.rstrip('\n').rstrip(' '), self.data_width//4) for item in next_n_lines]
-                    iter_buffer[block_index % self.fmaps_per_buffer].extend(xline)
-                    block_index += 1
-                    lines_read += self.poy
-                iterations.append(iter_buffer)
-        return iterations
+        if os.path.getsize(file_path) == 0:
+            return self.decode(np.zeros(0, dtype=np.uint8))
+        return self.decode(np.memmap(file_path, dtype=np.uint8, mode='r'))
+
+    def decode(self, raw):
+        """ Decode a uint8 array of fixed-width hex lines, see decode_lines. """
+        digits = self.data_width // 4
+        if raw.size == 0:
+            return np.zeros((0, 0), dtype=np.int64), np.zeros((0, 0), dtype=bool)
+        breaks = np.flatnonzero(raw[:MAX_LINE_BYTES] == ord('\n'))
+        width = int(breaks[0]) + 1 if len(breaks) else raw.size
+        first = bytes(raw[:width])
+        content = len(first.rstrip(b'\r\n').rstrip(b' '))
+        num_lines = -(-raw.size // width)
+        if raw.size % width:
+            # Last line without line break
+            chars = np.full(num_lines * width, ord('\n'), dtype=np.uint8)
+            chars[:raw.size] = raw
+        else:
+            chars = raw
+        words = content // digits
+        chars = chars.reshape(num_lines, width)[:, :words * digits].reshape(num_lines, words, digits)
 
-    def outputbrams2fmaps(self, data, rows, cols, tile_iterations, pooling=False, save_img=False):
-        iterations = [ [] for _ in range(tile_iterations) ]
-        ctr = 0
-        for idx, outputfile in enumerate(data):
-            for jdx, iteration in enumerate(outputfile):
-                for fmap_buffer in iteration:
-                    pix = self.outputbram2fmap(fmap_buffer, rows, cols, pooling)
-                    if(save_img):
-                        temp = np.square(pix) > 1500
-                        img = Image.fromarray((temp * 255).astype('uint8'), mode='L')
-                        img.save('my{}.png'.format(str(ctr)))
-                        ctr += 1
-                        # img.show()
-                    iterations[jdx].append(pix)
-        return iterations
+        nibbles = NIBBLES[chars]
+        valid = np.logical_and.accumulate((nibbles >= 0).all(axis=2), axis=1)
+        values = np.zeros((num_lines, words), dtype=np.int64)
+        for k in range(digits):
+            values <<= 4
+            values |= nibbles[:, :, k]
+        sign = 1 << (self.data_width - 1)
+        values -= ((values & sign) != 0) * (sign << 1)
+        return values, valid
 
-    def outputbram2fmap(self, bram, rows, cols, pooling=False):
-        """ Store internal buffer into 2d image representation.
-                @cols - number of image cols
-                @rows - number of image rows
+    def read_outbuffer(self, file_path, rows, cols, tile_iterations):
+        """ Reads a dataflow dump in text-based format into an
+            (iterations, fmaps_per_buffer, rows, cols) array.
+            Every iteration takes an equal share of the lines, blocks of poy
+            lines alternate between the fmaps of the buffer.
         """
-        # Container to store the relevant pixel data. 
-        r = rows
-        c = cols
+        values, valid = self.decode_lines(file_path)
+        # Iterations read whole blocks: a trailing partial block runs on into
+        # the next iteration's lines, lines missing at the end read as zeros
+        lines = -(-(len(values) // tile_iterations) // self.poy) * self.poy * tile_iterations
+        if lines > len(values):
+            values = np.concatenate((values, np.zeros((lines - len(values), values.shape[1]), dtype=values.dtype)))
+            valid = np.concatenate((valid, np.zeros((lines - len(valid), valid.shape[1]), dtype=bool)))
+        return self.arrange(values[:lines], valid[:lines], rows, cols, tile_iterations)
 
-        if pooling:
-            r = rows // 2
-            c= cols // 2
+    def arrange(self, values, valid, rows, cols, tile_iterations):
+        """ Reorder decoded lines of one buffer into fmaps, see read_outbuffer. """
+        lines_per_iteration = len(values) // tile_iterations
+        words = values.shape[1]
 
-        pix = np.zeros((r, c))
-    
-        #Convert the dataflow representation into 2d image map
-        for index, buffer_line in enumerate(bram):
-            for idx, _ in enumerate(buffer_line):
-                try:
-                    pix[index % r, index // r * self.pox + idx]  = OutputReader.twos_complement(buffer_line[idx],self.data_width) 
-                except:
-                    break
-        return pix
\ No newline at end of file
+        # (iterations, blocks, poy, words) -> (iterations, fmaps, lines, words)
+        blocks = lines_per_iteration // self.poy
+        fmap_blocks = -(-blocks // self.fmaps_per_buffer)
+        shape = (tile_iterations, fmap_blocks * self.fmaps_per_buffer, self.poy, words)
+        used = tile_iterations * lines_per_iteration
+        data = np.zeros(shape, dtype=np.int64)
+        mask = np.zeros(shape, dtype=bool)
+        data[:, :blocks] = values[:used].reshape(tile_iterations, blocks, self.poy, words)
+        mask[:, :blocks] = valid[:used].reshape(tile_iterations, blocks, self.poy, words)
+        shape = (tile_iterations, fmap_blocks, self.fmaps_per_buffer, self.poy, words)
+        data = data.reshape(shape).transpose(0, 2, 1, 3, 4)
+        mask = mask.reshape(shape).transpose(0, 2, 1, 3, 4)
+
+        # Line index of an fmap runs down the rows, then on by pox columns
+        index = np.arange(fmap_blocks * self.poy)[:, None]
+        col = index // rows * self.pox + np.arange(words)
+        target = (index % rows) * cols + col
+        mask = mask.reshape(tile_iterations * self.fmaps_per_buffer, -1) & (col < cols).ravel()
+        target = np.where(mask, target.ravel(), rows * cols)
+
+        pix = np.zeros((len(target), rows * cols + 1), dtype=np.int64)
+        pix[np.arange(len(target))[:, None], target] = data.reshape(len(target), -1)
+        return pix[:, :-1].reshape(tile_iterations, self.fmaps_per_buffer, rows, cols)
+
+    def outputbrams2fmaps(self, data, save_img=False):
+        fmaps = np.concatenate(data, axis=1)
+        if save_img:
+            images = np.concatenate([buffer.reshape(-1, *buffer.shape[2:]) for buffer in data])
+            for ctr, pix in enumerate(images):
+                temp = np.square(pix) > 1500
+                img = Image.fromarray((temp * 255).astype('uint8'), mode='L')
+                img.save('my{}.png'.format(str(ctr)))
+        return fmaps
@@ -0,0 +1,124 @@
+import inspect
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+
+@contextmanager
+def no_retain(layers):
+    """ Switch storing of inputs/intermediates on the layers off for the
+        duration of the block, the previous settings are restored after.
+    """
+    owners = [owner for layer in layers for owner in (layer, getattr(layer, 'conv', None))
+              if hasattr(owner, 'retain')]
+    previous = [owner.retain for owner in owners]
+    for owner in owners:
+        owner.retain = False
+    try:
+        yield
+    finally:
+        for owner, retain in zip(owners, previous):
+            owner.retain = retain
+
+
+def accepts_out(layer):
+    """ Whether layer.forward can write into a caller-provided buffer. """
+    return 'out' in inspect.signature(layer.forward).parameters
+
+
+class ActivationArena():
+    """ Memory plan for no-retain inference of a fixed input shape.
+
+        A dry run over a single image yields every layer's output shape and
+        dtype. Two ping-pong buffers of the largest activation and one shared
+        workspace (im2col columns, fixed-point input casts) are allocated once
+        and handed to the layers through out=/workspace= on every call. Layers without an out= argument
+        (Flatten) are called as they are and keep whatever they return.
+
+        The returned result lives in the arena and is overwritten by the
+        next run, copy it if it has to outlive that.
+    """
+
+    def __init__(self, layers, X_shape, dtype):
+        self.layers = layers
+        self.X_shape = tuple(X_shape)
+        self.dtype = np.dtype(dtype)
+        n_X = self.X_shape[0]
+
+        temp = np.zeros((1,) + self.X_shape[1:], dtype=self.dtype)
+        self.plan = []
+        current, sizes, workspace = None, [0, 0], 0
+        for layer in layers:
+            if hasattr(layer, 'workspace_size'):
+                workspace = max(workspace, layer.workspace_size(n_X, temp.dtype))
+            out = layer.forward(temp)
+            shape = (n_X,) + out.shape[1:]
+            if not accepts_out(layer):
+                self.plan.append((layer, None, shape, out.dtype))
+            else:
+                current = 0 if current != 0 else 1
+                sizes[current] = max(sizes[current], int(np.prod(shape)) * out.dtype.itemsize)
+                self.plan.append((layer, current, shape, out.dtype))
+            temp = out
+
+        self.buffers = [np.empty(size, dtype=np.uint8) for size in sizes]
+        self.workspace = np.empty(workspace, dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self.buffers) + self.workspace.nbytes
+
+    def run(self, X):
+        if X.shape != self.X_shape or X.dtype != self.dtype:
+            raise ValueError("Arena planned for {} {}, got {} {}".format(
+                self.X_shape, self.dtype, X.shape, X.dtype))
+        temp = X
+        for layer, target, shape, dtype in self.plan:
+            if target is None:
+                temp = layer.forward(temp)
+            elif hasattr(layer, 'workspace_size'):
+                out = np.ndarray(shape, dtype, buffer=self.buffers[target])
+                temp = layer.forward(temp, out=out, workspace=self.workspace)
+            else:
+                out = np.ndarray(shape, dtype, buffer=self.buffers[target])
+                temp = layer.forward(temp, out=out)
+        return temp
+
+
+def check_steady_state(n_X=(1, 32), limit=16 * 1024, seed=None):
+    """ Plan a small im2col Conv/ReLU/Maxpool/FC net, in float and in fixed
+        point, warm its arena up and trace a second CNN.infer. The traced
+        peak has to stay below limit bytes for every batch size in n_X, i.e.
+        it must not grow with the batch.
+        Raises AssertionError otherwise, returns the largest peak.
+    """
+    from .fixedpoint import FixedPoint
+    from .layers import Conv, ReLU, Maxpool, Flatten, FullyConnected
+    from .nnet import CNN
+
+    rng = np.random.default_rng(seed)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    largest = 0
+    try:
+        for fixed in (None, FixedPoint()):
+            net = CNN([Conv((3, 16, 16), 8, 3, 3, 1, 1, fixed=fixed, engine='im2col'), ReLU(fixed=fixed),
+                       Maxpool((8, 16, 16), 2, 2), Flatten(), FullyConnected(8 * 8 * 8, 10, fixed=fixed)])
+            for n in n_X:
+                X = rng.integers(-128, 128, size=(n, 3, 16, 16)) if fixed else rng.standard_normal((n, 3, 16, 16))
+                net.infer(X)
+                tracemalloc.reset_peak()
+                traced = tracemalloc.get_traced_memory()[0]
+                net.infer(X)
+                peak = tracemalloc.get_traced_memory()[1] - traced
+                assert peak < limit, "{}, {} images: second infer() allocated {} bytes".format(
+                    fixed or 'float', n, peak)
+                largest = max(largest, peak)
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return largest
+
+if __name__ == '__main__':
+    print("steady-state infer() peak: {} bytes".format(check_steady_state()))
@@ -0,0 +1,133 @@
+import copy
+import io
+import pickle
+import time
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from .parallel import ParallelExecutor
+from .utils import accuracy
+
+# Per-forward intermediates, never worth shipping to the workers
+TRANSIENT = ('X', 'X_col', 'max_indexes', 'out')
+
+# Worker process state, set once by _init_worker
+_model = None
+_X = None
+_blocks = []
+
+
+class _SharedPickler(pickle.Pickler):
+    """ Pickles arrays as references to shared memory blocks, each array once. """
+
+    def __init__(self, file, blocks):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.blocks = blocks
+        self.names = {}
+
+    def persistent_id(self, obj):
+        if isinstance(obj, ParallelExecutor):
+            return ('executor',)
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+            return None
+        if id(obj) not in self.names:
+            block = shared_memory.SharedMemory(create=True, size=max(obj.nbytes, 1))
+            np.ndarray(obj.shape, obj.dtype, buffer=block.buf)[...] = obj
+            self.blocks.append(block)
+            self.names[id(obj)] = (block.name, obj.shape, obj.dtype.str)
+        return ('array',) + self.names[id(obj)]
+
+
+class _SharedUnpickler(pickle.Unpickler):
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.arrays = {}
+
+    def persistent_load(self, pid):
+        if pid[0] == 'executor':
+            return None
+        name, shape, dtype = pid[1:]
+        if name not in self.arrays:
+            # Pool workers share the parent's resource tracker, the parent unlinks
+            block = shared_memory.SharedMemory(name=name)
+            _blocks.append(block)
+            array = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            self.arrays[name] = array
+        return self.arrays[name]
+
+
+def _strip(layer):
+    """ Shallow copy of a layer without intermediates or thread pools. """
+    layer = copy.copy(layer)
+    for name, value in list(vars(layer).items()):
+        if name in TRANSIENT:
+            delattr(layer, name)
+        elif hasattr(value, 'forward'):
+            setattr(layer, name, _strip(value))
+    return layer
+
+
+def _init_worker(model_bytes, X_bytes):
+    global _model, _X
+    _model = _SharedUnpickler(io.BytesIO(model_bytes)).load()
+    _X = _SharedUnpickler(io.BytesIO(X_bytes)).load()
+
+
+def _predict_range(task):
+    start, stop, batch_size = task
+    return start, _model.predict(_X[start:stop], batch_size=batch_size)
+
+
+def predict_parallel(cnn, X, workers=None, chunk_size=256, batch_size=None):
+    """ Generator over (start, predictions) for shards of X, in completion order.
+        Weights and X are copied into shared memory once, workers only
+        receive shard bounds.
+            @chunk_size - images per task
+            @batch_size - micro-batch size inside a worker, see CNN.forward
+    """
+    blocks = []
+    try:
+        model = copy.copy(cnn)
+        model.layers = [_strip(layer) for layer in cnn.layers]
+        model.params = [layer.params for layer in model.layers]
+
+        buffers = []
+        for obj in (model, np.asarray(X)):
+            buffer = io.BytesIO()
+            _SharedPickler(buffer, blocks).dump(obj)
+            buffers.append(buffer.getvalue())
+
+        tasks = [(start, min(start + chunk_size, len(X)), batch_size)
+                 for start in range(0, len(X), chunk_size)]
+        with Pool(workers, initializer=_init_worker, initargs=tuple(buffers)) as pool:
+            for start, predictions in pool.imap_unordered(_predict_range, tasks):
+                yield start, predictions
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def evaluate(cnn, X, y, workers=None, chunk_size=256, batch_size=None, verbose=False):
+    """ Accuracy of cnn over (X, y), computed incrementally from the worker
+        process stream. Returns accuracy, number of images, wall time and
+        throughput in images/sec.
+    """
+    t_start = time.perf_counter()
+    correct, seen = 0.0, 0
+    for start, predictions in predict_parallel(cnn, X, workers, chunk_size, batch_size):
+        n = len(predictions)
+        correct += accuracy(y[start:start + n], predictions) * n
+        seen += n
+        if verbose:
+            elapsed = time.perf_counter() - t_start
+            print("{}/{} images, accuracy {:.4f}, {:.1f} images/sec".format(
+                seen, len(X), correct / seen, seen / elapsed))
+    elapsed = time.perf_counter() - t_start
+    return {
+        'accuracy': correct / max(seen, 1),
+        'images': seen,
+        'seconds': elapsed,
+        'images_per_sec': seen / elapsed if elapsed else float('inf'),
+    }
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class FixedPoint():
+    """ Integer arithmetic of the accelerator datapath.
+
+        Configured with the same DataWidth/WeightWidth generics that
+        ProcessingSystem.initialize hands to the testbench. The MACs
+        accumulate in DataWidth+WeightWidth bits and hand out the lower
+        DataWidth bits, which is modelled here with int64 arithmetic.
+            @overflow - 'wrap' (two's complement, as the RTL) or 'saturate'
+    """
+
+    BATCHNORM_WIDTH = 16
+
+    def __init__(self, data_width=16, weight_width=16, overflow='wrap'):
+        if overflow not in ('wrap', 'saturate'):
+            raise ValueError("overflow must be 'wrap' or 'saturate'")
+        if data_width + weight_width > 64:
+            raise ValueError("Accumulator does not fit into int64!")
+        self.data_width = data_width
+        self.weight_width = weight_width
+        self.acc_width = data_width + weight_width
+        self.overflow = overflow
+
+    def __repr__(self):
+        return 'FixedPoint(data_width={}, weight_width={}, overflow={!r})'.format(
+            self.data_width, self.weight_width, self.overflow)
+
+    def cast(self, X, width, out=None):
+        """ Reduce an integer array to a signed `width`-bit range.
+            With out (an int64 array, may be X itself) nothing is allocated.
+        """
+        X = np.asarray(X)
+        if out is None:
+            out = X.astype(np.int64) if X.dtype != np.int64 else X.copy()
+        elif out is not X:
+            np.copyto(out, X, casting='unsafe')
+        if width >= 64:
+            return out
+        low, high = -(1 << (width - 1)), (1 << (width - 1)) - 1
+        if self.overflow == 'saturate':
+            return np.clip(out, low, high, out=out)
+        sign = 1 << (width - 1)
+        out += sign
+        out &= (1 << width) - 1
+        out -= sign
+        return out
+
+    def data(self, X, out=None):
+        return self.cast(X, self.data_width, out)
+
+    def weights(self, W, out=None):
+        return self.cast(W, self.weight_width, out)
+
+    def accumulate(self, X, out=None):
+        """ MAC result as seen on the DataWidth output of the accumulator. """
+        out = self.cast(X, self.acc_width, out)
+        return self.data(out, out)
+
+    def batchnorm(self, param):
+        return self.cast(param, FixedPoint.BATCHNORM_WIDTH)
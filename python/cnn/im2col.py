@@ -1,26 +1,55 @@
 import numpy as np
+from functools import lru_cache
+
+# Number of distinct (shape, field, padding, stride) index plans kept alive.
+IM2COL_PLAN_CACHE_SIZE = 64
 
 
 def get_im2col_indices(x_shape, field_height=3, field_width=3, padding=1, stride=1):
-  # First figure out what the size of the output should be
+  """ Return the (k, i, j) gather indices for im2col.
+
+  The plan does not depend on the batch size, so it is cached per
+  (C, H, W, field, padding, stride). The returned arrays are shared and
+  read-only.
+  """
   N, C, H, W = x_shape
+  return _im2col_plan((int(C), int(H), int(W)), int(field_height),
+                      int(field_width), int(padding), int(stride))
+
+
+@lru_cache(maxsize=IM2COL_PLAN_CACHE_SIZE)
+def _im2col_plan(chw_shape, field_height, field_width, padding, stride):
+  # First figure out what the size of the output should be
+  C, H, W = chw_shape
   assert (H + 2 * padding - field_height) % stride == 0
-  assert (W + 2 * padding - field_height) % stride == 0
-  out_height = (H + 2 * padding - field_height) / stride + 1
-  out_width = (W + 2 * padding - field_width) / stride + 1
+  assert (W + 2 * padding - field_width) % stride == 0
+  out_height = (H + 2 * padding - field_height) // stride + 1
+  out_width = (W + 2 * padding - field_width) // stride + 1
 
   i0 = np.repeat(np.arange(field_height,dtype='int32'), field_width)
   i0 = np.tile(i0, C)
   i1 = stride * np.repeat(np.arange(out_height,dtype='int32'), out_width)
-  j0 = np.tile(np.arange(field_width), field_height * C)
-  j1 = stride * np.tile(np.arange(out_width,dtype='int32'), int(out_height))
+  j0 = np.tile(np.arange(field_width,dtype='int32'), field_height * C)
+  j1 = stride * np.tile(np.arange(out_width,dtype='int32'), out_height)
   i = i0.reshape(-1, 1) + i1.reshape(1, -1)
   j = j0.reshape(-1, 1) + j1.reshape(1, -1)
 
   k = np.repeat(np.arange(C,dtype='int32'), field_height * field_width).reshape(-1, 1)
 
+  for index in (k, i, j):
+    index.flags.writeable = False
   return (k, i, j)
 
+
+def im2col_cache_info():
+  """ Hit/miss statistics of the im2col index plan cache. """
+  return _im2col_plan.cache_info()
+
+
+def im2col_cache_clear():
+  """ Drop all cached im2col index plans and reset the statistics. """
+  _im2col_plan.cache_clear()
+
 def im2col_indices(x, field_height=3, field_width=3, padding=1, stride=1):
   """ An implementation of im2col based on some fancy indexing """
   # Zero-pad the input
@@ -51,4 +80,65 @@ def col2im_indices(cols, x_shape, field_height=3, field_width=3, padding=1,
     return x_padded
   return x_padded[:, :, padding:-padding, padding:-padding]
 
-pass
\ No newline at end of file
+pass
+
+def get_col2im_offsets(x_shape, field_height=3, field_width=3, padding=1, stride=1):
+  """ Linear offsets of the (k, i, j) plan into one padded (C, H, W) image. """
+  N, C, H, W = x_shape
+  return _col2im_offsets((int(C), int(H), int(W)), int(field_height),
+                         int(field_width), int(padding), int(stride))
+
+
+@lru_cache(maxsize=IM2COL_PLAN_CACHE_SIZE)
+def _col2im_offsets(chw_shape, field_height, field_width, padding, stride):
+  C, H, W = chw_shape
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  k, i, j = _im2col_plan(chw_shape, field_height, field_width, padding, stride)
+  offsets = (k.astype(np.intp) * H_padded + i) * W_padded + j
+  offsets.flags.writeable = False
+  return offsets
+
+
+def col2im_bincount(cols, x_shape, field_height=3, field_width=3, padding=1,
+                    stride=1):
+  """ col2im accumulating with np.bincount over flattened plan offsets.
+  np.bincount sums in float64, integer inputs are exact below 2**53.
+  """
+  N, C, H, W = x_shape
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  plane = C * H_padded * W_padded
+  offsets = get_col2im_offsets(x_shape, field_height, field_width, padding,
+                               stride)
+  # cols is laid out as (C*kh*kw, L, N), matching offsets[:, :, None]
+  index = offsets[:, :, None] + plane * np.arange(N, dtype=np.intp)
+  x_padded = np.bincount(index.ravel(), weights=cols.ravel(), minlength=N * plane)
+  x_padded = x_padded.astype(cols.dtype, copy=False).reshape(N, C, H_padded, W_padded)
+  if padding == 0:
+    return x_padded
+  return x_padded[:, :, padding:-padding, padding:-padding]
+
+
+def col2im_strided(cols, x_shape, field_height=3, field_width=3, padding=1,
+                   stride=1, out=None):
+  """ col2im as kh*kw strided slice additions, one per kernel offset.
+  out - optional (N, C, H + 2p, W + 2p) buffer reused across calls
+  """
+  N, C, H, W = x_shape
+  H_padded, W_padded = H + 2 * padding, W + 2 * padding
+  out_height = (H_padded - field_height) // stride + 1
+  out_width = (W_padded - field_width) // stride + 1
+  if out is None:
+    out = np.zeros((N, C, H_padded, W_padded), dtype=cols.dtype)
+  else:
+    out[...] = 0
+  cols_reshaped = cols.reshape(C, field_height, field_width, out_height,
+                               out_width, N)
+  for y in range(field_height):
+    y_max = y + stride * out_height
+    for x in range(field_width):
+      x_max = x + stride * out_width
+      out[:, :, y:y_max:stride, x:x_max:stride] += \
+        cols_reshaped[:, y, x].transpose(3, 0, 1, 2)
+  if padding == 0:
+    return out
+  return out[:, :, padding:-padding, padding:-padding]
@@ -1,22 +1,70 @@
 import numpy as np
 from .im2col import *
+from .fixedpoint import FixedPoint
+from .winograd import transform_kernels, winograd_conv3x3
+from .parallel import ParallelExecutor
 
 
-class Conv():
+def _into(out, result):
+    """ Hand back result, or copy it into a caller-provided buffer. """
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
+
 
-    def __init__(self, X_dim, n_filter, h_filter, w_filter, stride, padding):
+def _add_rows(out, row):
+    """ out[n] += row for every n of a C-contiguous out. Broadcasting ufuncs
+        allocate an iteration buffer, same-shaped rows do not.
+    """
+    row = row.reshape(-1)
+    for item in out.reshape(len(out), -1):
+        item += row
+
+
+class Conv():
+    """ Convolution layer.
+            @engine - 'im2col' (fancy-index gather + GEMM), 'strided'
+                      (read-only sliding-window view copied into the im2col
+                      layout, same GEMM and bit-identical results),
+                      'winograd' (F(2x2,3x3), 3x3/S1 only, opt-in) or 'auto',
+                      which picks winograd for the conv3x3_S1_P1 type in
+                      fixed point, where it is exact, and im2col else
+            @executor - optional ParallelExecutor. The im2col GEMM is split by
+                      filter groups or output row tiles, the other engines
+                      always run on output row tiles.
+    """
+
+    ENGINES = ('im2col', 'strided', 'winograd')
+
+    def __init__(self, X_dim, n_filter, h_filter, w_filter, stride, padding, fixed=None, engine='im2col', executor=None):
 
         self.d_X, self.h_X, self.w_X = X_dim
 
         self.n_filter, self.h_filter, self.w_filter = n_filter, h_filter, w_filter
         self.stride, self.padding = stride, padding
 
+        if engine == 'auto':
+            conv3x3_S1_P1 = (h_filter, w_filter, stride, padding) == (3, 3, 1, 1)
+            engine = 'winograd' if conv3x3_S1_P1 and fixed else 'im2col'
+        if engine not in Conv.ENGINES:
+            raise ValueError("Unknown convolution engine: {}".format(engine))
+        if engine == 'winograd' and (h_filter, w_filter, stride) != (3, 3, 1):
+            raise ValueError("Winograd engine requires 3x3 kernels with stride 1")
+        self.engine = engine
+        self.U, self.U_src = None, None
+        self.executor = executor
+        # Keep X_col for inspection after forward; off in no-retain inference
+        self.retain = True
+        self.gather = None
+
         self.W = np.random.randint(-128, 127, size=(n_filter, self.d_X, h_filter, w_filter))
 
         # self.W = np.random.randn(
         #     n_filter, self.d_X, h_filter, w_filter) / np.sqrt(n_filter / 2.)
 
-        self.b = np.zeros((self.n_filter, 1))
+        self.fixed = fixed
+        self.b = np.zeros((self.n_filter, 1), dtype=np.int64 if fixed else float)
         self.params = [self.W, self.b]
 
         self.h_out = (self.h_X - h_filter + 2 * padding) / stride + 1
@@ -28,18 +76,183 @@ class Conv():
         self.h_out, self.w_out = int(self.h_out), int(self.w_out)
         self.out_dim = (self.n_filter, self.h_out, self.w_out)
 
-    def forward(self, X):
-
+    def forward(self, X, out=None, workspace=None):
+        """ out       - optional (N, F, h_out, w_out) result buffer
+            workspace - optional flat uint8 buffer of workspace_size() bytes;
+                        with out, the im2col engine then allocates nothing
+        """
         self.n_X = X.shape[0]
-
-        self.X_col = im2col_indices(
+        if self.engine != 'im2col':
+            p = self.padding
+            X_padded = np.pad(X, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+            return _into(out, self.convolve(X_padded))
+        if out is not None and workspace is not None and self.executor is None:
+            return self._forward_planned(X, out, workspace)
+
+        W = self.W
+        if self.fixed:
+            X, W = self.fixed.data(X), self.fixed.weights(W)
+
+        X_col = im2col_indices(
             X, self.h_filter, self.w_filter, stride=self.stride, padding=self.padding)
-        W_row = self.W.reshape(self.n_filter, -1)
+        if self.retain:
+            self.X_col = X_col
+        W_row = W.reshape(self.n_filter, -1)
+
+        result = self._gemm(W_row, X_col) + self.b
+        if self.fixed:
+            result = self.fixed.accumulate(result, out=result)
+        result = result.reshape(self.n_filter, self.h_out, self.w_out, self.n_X)
+        result = result.transpose(3, 0, 1, 2)
+
+        return _into(out, result)
+
+    def workspace_size(self, n_X, dtype):
+        """ Bytes of the bias expanded to one output image, the padded input
+            and the (N, C*kh*kw, h_out*w_out) columns.
+        """
+        out_dtype = np.int64 if self.fixed else np.result_type(dtype, self.W, self.b)
+        if self.fixed:
+            dtype = np.int64
+        p = self.padding
+        bias = self.n_filter * self.h_out * self.w_out
+        padded = n_X * self.d_X * (self.h_X + 2 * p) * (self.w_X + 2 * p)
+        cols = n_X * self.d_X * self.h_filter * self.w_filter * self.h_out * self.w_out
+        return bias * np.dtype(out_dtype).itemsize + (padded + cols) * np.dtype(dtype).itemsize
+
+    def scratch_bytes(self, n_X, dtype, rows=None):
+        """ Bytes forward() allocates for n_X images besides its output, with
+            the layer's engine: padded input, engine intermediates and the
+            raw product. rows limits the output rows (FusedConvBlock tiles).
+        """
+        dtype = np.int64 if self.fixed else np.result_type(dtype, self.W, self.b)
+        h_out = self.h_out if rows is None else min(rows, self.h_out)
+        padded = self.d_X * ((h_out - 1) * self.stride + self.h_filter) * (self.w_X + 2 * self.padding)
+        result = self.n_filter * h_out * self.w_out
+        if self.engine == 'winograd':
+            # Extended input, B^T d B terms and V, M in the 16 point domain
+            t_h, t_w = -(-h_out // 2), -(-self.w_out // 2)
+            extended = self.d_X * (2 * t_h + 2) * (2 * t_w + 2)
+            size = padded + extended + 32 * self.d_X * t_h * t_w + 20 * self.n_filter * t_h * t_w
+        else:
+            # X_col, gathered (im2col) or copied from the window view (strided)
+            size = padded + self.d_X * self.h_filter * self.w_filter * h_out * self.w_out
+        return n_X * (size + 2 * result) * np.dtype(dtype).itemsize
+
+    def _forward_planned(self, X, out, workspace):
+        # im2col + GEMM inside preallocated buffers: the gather goes through
+        # np.take with the cached linear offsets, and the batched product
+        # lands directly in the (N, F, h_out, w_out) layout. Element-wise
+        # steps only touch contiguous operands, broadcasting ones would
+        # allocate an iteration buffer on every call.
+        N, p = X.shape[0], self.padding
+        dtype = np.dtype(np.int64) if self.fixed else X.dtype
+        bias = np.ndarray((self.n_filter, self.h_out * self.w_out), out.dtype, buffer=workspace)
+        padded = np.ndarray((N, self.d_X, self.h_X + 2 * p, self.w_X + 2 * p), dtype,
+                            buffer=workspace, offset=bias.nbytes)
+        offsets, W_row = self._gather_plan(X.shape, dtype)
+        X_col = np.ndarray((N,) + offsets.shape, dtype, buffer=workspace,
+                           offset=bias.nbytes + padded.nbytes)
+
+        if p:
+            padded[:, :, :p] = 0
+            padded[:, :, -p:] = 0
+            padded[:, :, :, :p] = 0
+            padded[:, :, :, -p:] = 0
+        np.copyto(padded[:, :, p:p + self.h_X, p:p + self.w_X], X, casting='unsafe')
+        if self.fixed:
+            # The zero border stays zero
+            self.fixed.data(padded, out=padded)
+        np.take(padded.reshape(N, -1), offsets, axis=1, out=X_col, mode='clip')
+
+        np.matmul(W_row, X_col, out=out.reshape(N, self.n_filter, -1))
+        np.copyto(bias, self.b)
+        _add_rows(out, bias)
+        if self.fixed:
+            self.fixed.accumulate(out, out=out)
+        return out
 
-        out = W_row @ self.X_col + self.b
-        out = out.reshape(self.n_filter, self.h_out, self.w_out, self.n_X)
-        out = out.transpose(3, 0, 1, 2)
+    def convolve(self, X_padded):
+        """ Valid convolution of an already padded (N, C, H, W) input with the
+            layer's engine. Bias and fixed-point accumulation are applied.
+        """
+        W = self.W
+        if self.fixed:
+            X_padded, W = self.fixed.data(X_padded), self.fixed.weights(W)
+
+        convolve = getattr(self, '_convolve_' + self.engine)
+        if self.executor is not None and self.engine != 'im2col':
+            out = self._convolve_tiled(X_padded, W, convolve)
+        else:
+            out = convolve(X_padded, W)
+
+        out = out + self.b.reshape(1, -1, 1, 1)
+        if self.fixed:
+            out = self.fixed.accumulate(out)
+        return out
 
+    def winograd_kernels(self, W):
+        """ Winograd-domain kernels, transformed once per weight array. """
+        if self.U_src is not self.W:
+            self.U, self.U_src = transform_kernels(W), self.W
+        return self.U
+
+    def _gather_plan(self, X_shape, dtype):
+        # Built once per input shape and weight array. np.take copies read-only
+        # index arrays on every call, so the cached offsets get a private copy.
+        # The weights are cast up front to spare matmul a per-call conversion.
+        key = (X_shape, dtype)
+        if self.gather is None or self.gather[0] != key or self.gather[1] is not self.W:
+            offsets = np.array(get_col2im_offsets(X_shape, self.h_filter, self.w_filter,
+                                                  self.padding, self.stride))
+            W = self.fixed.weights(self.W) if self.fixed else self.W
+            W_row = W.reshape(self.n_filter, -1).astype(np.result_type(W, dtype))
+            self.gather = (key, self.W, offsets, W_row)
+        return self.gather[2:]
+
+    def _convolve_im2col(self, X_padded, W):
+        N, _, H, W_in = X_padded.shape
+        h_out = (H - self.h_filter) // self.stride + 1
+        w_out = (W_in - self.w_filter) // self.stride + 1
+        X_col = im2col_indices(
+            X_padded, self.h_filter, self.w_filter, stride=self.stride, padding=0)
+        if self.retain:
+            self.X_col = X_col
+        out = self._gemm(W.reshape(self.n_filter, -1), X_col)
+        return out.reshape(self.n_filter, h_out, w_out, N).transpose(3, 0, 1, 2)
+
+    def _convolve_strided(self, X_padded, W):
+        # (N, C, h_out, w_out, kh, kw) view on X_padded, nothing is copied here
+        windows = np.lib.stride_tricks.sliding_window_view(
+            X_padded, (self.h_filter, self.w_filter), axis=(2, 3))
+        windows = windows[:, :, ::self.stride, ::self.stride]
+        N, _, h_out, w_out = windows.shape[:4]
+        # One copy into the im2col (C*kh*kw, h_out*w_out*N) layout, so the GEMM
+        # sums in the same order as the im2col engine (bit-identical results)
+        X_col = windows.transpose(1, 4, 5, 2, 3, 0).reshape(-1, h_out * w_out * N)
+        out = self._gemm(W.reshape(self.n_filter, -1), X_col)
+        return out.reshape(self.n_filter, h_out, w_out, N).transpose(3, 0, 1, 2)
+
+    def _convolve_winograd(self, X_padded, W):
+        return winograd_conv3x3(X_padded, self.winograd_kernels(W))
+
+    def _gemm(self, W_row, X_col):
+        if self.executor is None:
+            return W_row @ X_col
+        # X_col columns are ordered (h_out, w_out, N): column chunks are row tiles
+        return self.executor.matmul(W_row, X_col, axis=0 if self.executor.split == 'filters' else 1)
+
+    def _convolve_tiled(self, X_padded, W, convolve):
+        N, _, H, W_in = X_padded.shape
+        h_out = (H - self.h_filter) // self.stride + 1
+        w_out = (W_in - self.w_filter) // self.stride + 1
+        out = np.empty((N, self.n_filter, h_out, w_out), dtype=np.result_type(X_padded, W))
+
+        def task(start, stop):
+            rows = X_padded[:, :, start * self.stride:(stop - 1) * self.stride + self.h_filter]
+            out[:, :, start:stop] = convolve(rows, W)
+
+        self.executor.map(task, h_out)
         return out
 
 
@@ -62,21 +275,45 @@ class Maxpool():
 
         self.h_out, self.w_out = int(self.h_out), int(self.w_out)
         self.out_dim = (self.d_X, self.h_out, self.w_out)
-
-    def forward(self, X):
+        self.retain = True
+
+    def scratch_bytes(self, n_X, dtype):
+        """ Bytes forward() allocates besides its output, nothing for
+            non-overlapping windows. Else the peak is inside im2col: the
+            padded input copy, the gathered columns and X_col.
+        """
+        if self.size == self.stride:
+            return 0
+        X_col = n_X * self.d_X * self.h_out * self.w_out * self.size * self.size
+        return (n_X * self.d_X * self.h_X * self.w_X + 2 * X_col) * np.dtype(dtype).itemsize
+
+    def forward(self, X, out=None):
         self.n_X = X.shape[0]
+        if self.size == self.stride:
+            # Non-overlapping windows (the accelerator's 2x2/S2 pooling):
+            # reduce a (N, C, h_out, s, w_out, s) strided view straight into
+            # out, no im2col gather and no temporaries.
+            s = self.size
+            sN, sC, sH, sW = X.strides
+            windows = np.lib.stride_tricks.as_strided(
+                X, (X.shape[0], X.shape[1], self.h_out, s, self.w_out, s),
+                (sN, sC, sH * s, sH, sW * s, sW), writeable=False)
+            return np.max(windows, axis=(3, 5), out=out)
+
         X_reshaped = X.reshape(
             X.shape[0] * X.shape[1], 1, X.shape[2], X.shape[3])
 
-        self.X_col = im2col_indices(
+        X_col = im2col_indices(
             X_reshaped, self.size, self.size, padding=0, stride=self.stride)
 
-        self.max_indexes = np.argmax(self.X_col, axis=0)
-        out = self.X_col[self.max_indexes, range(self.max_indexes.size)]
+        max_indexes = np.argmax(X_col, axis=0)
+        result = X_col[max_indexes, range(max_indexes.size)]
+        if self.retain:
+            self.X_col, self.max_indexes = X_col, max_indexes
 
-        out = out.reshape(self.h_out, self.w_out, self.n_X,
-                          self.d_X).transpose(2, 3, 0, 1)                        
-        return out
+        result = result.reshape(self.h_out, self.w_out, self.n_X,
+                                self.d_X).transpose(2, 3, 0, 1)
+        return _into(out, result)
 
 
 class Flatten():
@@ -86,7 +323,7 @@ class Flatten():
 
     def forward(self, X):
         self.X_shape = X.shape
-        self.out_shape = (self.X_shape[0], -1)
+        self.out_shape = (self.X_shape[0], int(np.prod(self.X_shape[1:])))
         out = X.ravel().reshape(self.out_shape)
         self.out_shape = self.out_shape[1]
         return out
@@ -94,63 +331,203 @@ class Flatten():
 
 class FullyConnected():
 
-    def __init__(self, in_size, out_size):
+    def __init__(self, in_size, out_size, fixed=None, executor=None):
         self.W = np.random.randint(-128, 127, size=(in_size, out_size))
-        self.b = np.zeros((1, out_size))
+        self.fixed = fixed
+        self.executor = executor
+        self.b = np.zeros((1, out_size), dtype=np.int64 if fixed else float)
         self.params = [self.W, self.b]
-
-    def forward(self, X):
-        self.X = X
-        out = self.X @ self.W + self.b
+        self.retain = True
+        self.W_cast = None
+
+    def forward(self, X, out=None, workspace=None):
+        """ workspace - optional flat uint8 buffer of workspace_size() bytes
+                        taking the fixed-point cast of X
+        """
+        if self.fixed:
+            if workspace is not None:
+                X = self.fixed.data(X, out=np.ndarray(X.shape, np.int64, buffer=workspace))
+            else:
+                X = self.fixed.data(X)
+        if self.retain:
+            self.X = X
+        W = self._weights_as(X.dtype)
+        if self.executor is not None:
+            result = self.executor.matmul(X, W, axis=1 if self.executor.split == 'filters' else 0)
+            out = _into(out, result)
+        elif out is not None:
+            np.matmul(X, W, out=out)
+        else:
+            out = X @ W
+        if out.dtype == np.result_type(out, self.b):
+            if out.flags.c_contiguous:
+                _add_rows(out, self.b)
+            else:
+                out += self.b
+        else:
+            out = out + self.b
+        if self.fixed:
+            out = self.fixed.accumulate(out, out=out)
         return out
 
+    def workspace_size(self, n_X, dtype):
+        """ Bytes of the int64 input cast, none in float. """
+        return n_X * self.W.shape[0] * np.dtype(np.int64).itemsize if self.fixed else 0
+
+    def _weights_as(self, dtype):
+        # Quantised/cast weights for repeated calls, rebuilt if W changes
+        if self.W_cast is None or self.W_cast[0] is not self.W or self.W_cast[1] != dtype:
+            W = self.fixed.weights(self.W) if self.fixed else self.W
+            self.W_cast = (self.W, dtype, W.astype(np.result_type(W, dtype)))
+        return self.W_cast[2]
+
 
 class Batchnorm():
 
-    def __init__(self, X_dim, alpha, beta):
+    def __init__(self, X_dim, alpha, beta, fixed=None):
         self.k_X, self.d_X, self.h_X, self.w_X = X_dim
         # print(X_dim)
+        self.fixed = fixed
+        if fixed:
+            alpha, beta = fixed.batchnorm(alpha), fixed.batchnorm(beta)
         self.alpha = np.full((1, int(np.prod(X_dim))), alpha)
         self.beta = np.full((1, int(np.prod(X_dim))), beta)
         self.params = [self.alpha, self.beta]
 
-    def forward(self, X):
+    def forward(self, X, out=None):
         self.n_X = X.shape[0]
         self.X_shape = X.shape
 
         print(self.X_shape)
         X_flat = X.ravel().reshape(self.n_X, -1)
+        if self.fixed:
+            X_flat = self.fixed.data(X_flat)
         # self.X_norm = (self.X_flat - self.mu) / np.sqrt(self.var + 1e-8)
-        out = self.alpha * X_flat + self.beta
+        if out is None:
+            result = self.alpha * X_flat + self.beta
+        else:
+            result = out.reshape(self.n_X, -1)
+            np.multiply(self.alpha, X_flat, out=result)
+            result += self.beta
+        if self.fixed:
+            result = self.fixed.data(result, out=result)
 
-        return out.reshape(self.X_shape)
+        return result.reshape(self.X_shape)
 
 
 class ReLU():
-    def __init__(self):
+    def __init__(self, fixed=None):
+        self.fixed = fixed
         self.params = []
+        self.retain = True
+
+    def forward(self, X, out=None):
+        if self.fixed:
+            X = self.fixed.data(X, out=out)
+        if self.retain:
+            self.X = X
+        return np.maximum(0, X, out=out)
+
+
+class FusedConvBlock():
+    """ Conv -> ReLU -> Batchnorm -> Maxpool(2x2/S2) in a single pass, as the
+        accelerator runs it. The stages are selected by the same opMode string
+        simulate_win32.py hands to ps.set_opMode, e.g. "\"1101\"":
+            - **00 - convolution
+            - **01 - convolution + pooling
+            - *1** - ReLU active
+            - 1*** - BatchNormalization active
+        The output is produced tile_rows conv rows at a time, so only one tile
+        of conv results is alive. alpha/beta are scalars or per-filter arrays.
+    """
+
+    def __init__(self, X_dim, n_filter, h_filter, w_filter, stride, padding, opMode,
+                 alpha=1, beta=0, fixed=None, engine='im2col', tile_rows=8, executor=None):
+        mode = opMode.strip('"')
+        if len(mode) != 4 or mode[2:] not in ('00', '01'):
+            raise ValueError("opMode {} is not a convolution mode".format(opMode))
+        self.batchnorm, self.relu, self.pooling = mode[0] == '1', mode[1] == '1', mode[3] == '1'
+
+        self.conv = Conv(X_dim, n_filter, h_filter, w_filter, stride, padding,
+                         fixed=fixed, engine=engine, executor=executor)
+        self.W, self.b = self.conv.W, self.conv.b
+        self.fixed = fixed
+
+        if fixed:
+            alpha, beta = fixed.batchnorm(alpha), fixed.batchnorm(beta)
+        self.alpha = np.reshape(alpha, (1, -1, 1, 1))
+        self.beta = np.reshape(beta, (1, -1, 1, 1))
+        self.params = [self.W, self.b, self.alpha, self.beta]
+
+        # Pooled tiles need whole 2x2 windows
+        self.tile_rows = max(tile_rows - tile_rows % 2, 2) if self.pooling else max(tile_rows, 1)
+
+        self.h_out, self.w_out = self.conv.h_out, self.conv.w_out
+        if self.pooling:
+            self.h_out, self.w_out = self.h_out // 2, self.w_out // 2
+        self.out_dim = (n_filter, self.h_out, self.w_out)
+
+    def scratch_bytes(self, n_X, dtype):
+        """ Bytes forward() allocates besides its output: the padded input
+            and the convolution of one tile.
+        """
+        conv = self.conv
+        padded = n_X * conv.d_X * (conv.h_X + 2 * conv.padding) * (conv.w_X + 2 * conv.padding)
+        return padded * np.dtype(dtype).itemsize + conv.scratch_bytes(n_X, dtype, rows=self.tile_rows)
+
+    def forward(self, X, out=None):
+        self.n_X = X.shape[0]
+        conv, p, s = self.conv, self.conv.padding, self.conv.stride
+        X_padded = np.pad(X, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+
+        for r0 in range(0, conv.h_out, self.tile_rows):
+            r1 = min(r0 + self.tile_rows, conv.h_out)
+            tile = conv.convolve(X_padded[:, :, r0 * s:(r1 - 1) * s + conv.h_filter])
+
+            if self.relu:
+                np.maximum(tile, 0, out=tile)
+            if self.batchnorm:
+                tile *= self.alpha
+                tile += self.beta
+                if self.fixed:
+                    self.fixed.data(tile, out=tile)
+
+            if out is None:
+                out = np.empty((self.n_X,) + self.out_dim, dtype=tile.dtype)
+            if self.pooling:
+                rows, cols = (r1 - r0) // 2, self.w_out
+                dst = out[:, :, r0 // 2:r0 // 2 + rows]
+                np.maximum(tile[:, :, 0:2 * rows:2, 0:2 * cols:2], tile[:, :, 0:2 * rows:2, 1:2 * cols:2], out=dst)
+                np.maximum(dst, tile[:, :, 1:2 * rows:2, 0:2 * cols:2], out=dst)
+                np.maximum(dst, tile[:, :, 1:2 * rows:2, 1:2 * cols:2], out=dst)
+            else:
+                out[:, :, r0:r1] = tile
 
-    def forward(self, X):
-        self.X = X
-        return np.maximum(0, X)
+        return out
 
 
 class sigmoid():
     def __init__(self):
         self.params = []
-
-    def forward(self, X):
-        out = 1.0 / (1.0 + np.exp(X))
-        self.out = out
+        self.retain = True
+
+    def forward(self, X, out=None):
+        out = np.exp(X, out=out)
+        out += 1.0
+        out = np.reciprocal(out, out=out)
+        if self.retain:
+            self.out = out
         return out
 
 
 class tanh():
     def __init__(self):
         self.params = []
+        self.retain = True
 
-    def forward(self, X):
-        out = np.tanh(X)
-        self.out = out
+    def forward(self, X, out=None):
+        out = np.tanh(X, out=out)
+        if self.retain:
+            self.out = out
         return out
 
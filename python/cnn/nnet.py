@@ -1,6 +1,7 @@
 import numpy as np
 from .loss import SoftmaxLoss, l2_regularization, delta_l2_regularization
 from .utils import accuracy, softmax
+from .arena import ActivationArena, no_retain
 
 class CNN:
 
@@ -10,13 +11,86 @@ class CNN:
         for layer in self.layers:
             self.params.append(layer.params)
         self.loss_func = loss_func
+        # Optional cnn.profiler.Profiler recording every layer call
+        self.profiler = None
+        self.arena = None
 
-    def forward(self, X):
+    def forward(self, X, batch_size=None, max_bytes=None):
+        """ Run X through the layer stack.
+                @batch_size - images per micro-batch, None runs X in one go
+                @max_bytes  - derive batch_size from a workspace budget instead
+        """
+        if batch_size is None and max_bytes is None:
+            return self._forward(X)
+        return np.concatenate(list(self.forward_batches(X, batch_size, max_bytes)))
+
+    def forward_batches(self, X, batch_size=None, max_bytes=None):
+        """ Generator streaming micro-batches of X through the layer stack.
+            Only one micro-batch worth of intermediates is alive at a time.
+        """
+        if len(X) == 0:
+            yield self._forward(X)
+            return
+        if batch_size is None:
+            batch_size = self.batch_size_for(max_bytes, X.dtype) if max_bytes else len(X)
+        for start in range(0, len(X), batch_size):
+            yield self._forward(X[start:start + batch_size])
+
+    def _forward(self, X):
         temp = X
+        if self.profiler is not None:
+            for index, layer in enumerate(self.layers):
+                temp = self.profiler.profile(index, layer, temp)
+            return temp
         for layer in self.layers:
             temp = layer.forward(temp)
         return temp
 
-    def predict(self, X):
-        X = self.forward(X)
-        return np.argmax(softmax(X), axis=1)
+    def infer(self, X):
+        """ No-retain inference: the layers keep no inputs or intermediates and
+            write into ping-pong buffers planned once per input shape/dtype.
+            Retaining is only off during the call, forward() is unaffected.
+            The result is a view into the arena, valid until the next call.
+        """
+        with no_retain(self.layers):
+            arena = self.arena
+            if arena is None or arena.X_shape != X.shape or arena.dtype != X.dtype:
+                self.arena = arena = ActivationArena(self.layers, X.shape, X.dtype)
+            return arena.run(X)
+
+    def batch_size_for(self, max_bytes, dtype=np.float64):
+        """ Largest micro-batch whose per-layer peak fits into max_bytes. """
+        per_image = max(self.workspace_bytes(1, dtype), 1)
+        return max(int(max_bytes // per_image), 1)
+
+    def workspace_bytes(self, n_X, dtype=np.float64):
+        """ Largest per-layer peak for n_X images of dtype: what the layer's
+            forward allocates (scratch_bytes, per engine) plus its output.
+        """
+        largest = 0
+        for layer in self.layers:
+            # Output dtype: fixed-point layers compute in int64
+            out_dtype = dtype
+            if getattr(getattr(layer, 'conv', layer), 'fixed', None):
+                out_dtype = np.int64
+            elif layer.params:
+                out_dtype = np.result_type(dtype, *layer.params)
+            if hasattr(layer, 'out_dim'):
+                out = int(np.prod(layer.out_dim))
+            elif hasattr(layer, 'W'):
+                out = layer.W.shape[1]
+            else:
+                out = 0
+            size = out * n_X * np.dtype(out_dtype).itemsize
+            if hasattr(layer, 'scratch_bytes'):
+                size += layer.scratch_bytes(n_X, dtype)
+            largest = max(largest, size)
+            dtype = out_dtype
+        return largest
+
+    def predict(self, X, batch_size=None, max_bytes=None):
+        if batch_size is None and max_bytes is None:
+            X = self.forward(X)
+            return np.argmax(softmax(X), axis=1)
+        return np.concatenate([np.argmax(softmax(out), axis=1)
+                               for out in self.forward_batches(X, batch_size, max_bytes)])
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelExecutor():
+    """ Thread pool splitting layer work into independent output slices.
+
+        NumPy releases the GIL inside matmul, including the non-BLAS integer
+        loops, so the slices run truly in parallel. Every task writes into a
+        preallocated slice of the result.
+            @workers - number of threads, defaults to the number of cores
+            @split   - 'filters' splits the filters into groups (the software
+                       analogue of Fparallelism), 'rows' splits output rows
+            @groups  - number of slices, defaults to workers
+    """
+
+    SPLITS = ('filters', 'rows')
+
+    def __init__(self, workers=None, split='filters', groups=None):
+        if split not in ParallelExecutor.SPLITS:
+            raise ValueError("split must be one of {}".format(ParallelExecutor.SPLITS))
+        self.workers = workers or os.cpu_count() or 1
+        self.split = split
+        self.groups = groups or self.workers
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def chunks(self, n):
+        """ Split range(n) into at most `groups` contiguous non-empty slices. """
+        bounds = np.linspace(0, n, min(self.groups, n) + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def map(self, func, n):
+        """ Run func(start, stop) for every chunk of range(n) and wait. """
+        futures = [self.pool.submit(func, start, stop) for start, stop in self.chunks(n)]
+        for future in futures:
+            future.result()
+
+    def matmul(self, A, B, axis=0):
+        """ A @ B, split over the rows of A (axis=0) or the columns of B (axis=1). """
+        out = np.empty((A.shape[0], B.shape[1]), dtype=np.result_type(A, B))
+        if axis == 0:
+            def task(start, stop):
+                np.matmul(A[start:stop], B, out=out[start:stop])
+        else:
+            def task(start, stop):
+                np.matmul(A, B[:, start:stop], out=out[:, start:stop])
+        self.map(task, out.shape[axis])
+        return out
@@ -0,0 +1,119 @@
+import json
+import time
+import tracemalloc
+import numpy as np
+
+
+def layer_macs(layer, n_X):
+    """ Analytic multiply-accumulates of one forward pass over n_X images. """
+    conv = getattr(layer, 'conv', layer)
+    if hasattr(conv, 'n_filter'):
+        return conv.W.size * conv.h_out * conv.w_out * n_X
+    if hasattr(layer, 'W'):
+        return layer.W.size * n_X
+    return 0
+
+
+def accelerator_gops(xpar, ypar, fpar, clock_period_ns=20):
+    """ Peak GOP/s of the Xparallelism*Yparallelism*Fparallelism MAC array,
+        one MAC (two ops) per PE and cycle. Default clock as in accelerator_tb.
+    """
+    return 2 * xpar * ypar * fpar / clock_period_ns
+
+
+class Profiler():
+    """ Per-layer timing and MAC/byte accounting for CNN.forward.
+        Attach with cnn.profiler = Profiler(); every layer call is recorded.
+            @memory - trace the allocations of every call with tracemalloc.
+                      The intermediate bytes are the call's allocation peak
+                      less its output, whatever the engine allocates (X_col,
+                      Winograd V/M, fused tiles, ...). Tracing slows the
+                      calls down, memory=False gives plain timings and no
+                      intermediate bytes.
+    """
+
+    COLUMNS = ('layer', 'name', 'calls', 'seconds', 'out_shape', 'dtype',
+               'macs', 'intermediate_bytes', 'out_bytes', 'gops')
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.records = []
+
+    def reset(self):
+        self.records = []
+
+    def profile(self, index, layer, X):
+        """ Run layer.forward(X) and record it. """
+        tracing = tracemalloc.is_tracing()
+        if self.memory:
+            if not tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+
+        t_start = time.perf_counter()
+        out = layer.forward(X)
+        seconds = time.perf_counter() - t_start
+
+        intermediate = 0
+        if self.memory:
+            intermediate = tracemalloc.get_traced_memory()[1] - traced
+            if not tracing:
+                tracemalloc.stop()
+            if not np.shares_memory(out, X):
+                intermediate = max(intermediate - out.nbytes, 0)
+
+        self.records.append({
+            'layer': index,
+            'name': type(layer).__name__,
+            'seconds': seconds,
+            'out_shape': list(out.shape),
+            'dtype': str(out.dtype),
+            'macs': int(layer_macs(layer, X.shape[0])),
+            'intermediate_bytes': int(intermediate),
+            'out_bytes': int(out.nbytes),
+        })
+        return out
+
+    def summary(self):
+        """ Records aggregated per layer, micro-batches are summed up. """
+        layers = {}
+        for record in self.records:
+            entry = layers.setdefault(record['layer'], dict(record, calls=0, seconds=0.0, macs=0,
+                                                            intermediate_bytes=0, out_bytes=0))
+            entry['calls'] += 1
+            entry['seconds'] += record['seconds']
+            entry['macs'] += record['macs']
+            entry['intermediate_bytes'] = max(entry['intermediate_bytes'], record['intermediate_bytes'])
+            entry['out_bytes'] = max(entry['out_bytes'], record['out_bytes'])
+            entry['out_shape'] = record['out_shape']
+        for entry in layers.values():
+            entry['gops'] = 2 * entry['macs'] / entry['seconds'] / 1e9 if entry['seconds'] else 0.0
+        return [layers[index] for index in sorted(layers)]
+
+    def to_json(self, path=None, peak_gops=None):
+        data = {'layers': self.summary()}
+        if peak_gops is not None:
+            data['accelerator_gops'] = peak_gops
+        text = json.dumps(data, indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def table(self, peak_gops=None):
+        """ Text table of the summary. With peak_gops (see accelerator_gops)
+            the achieved throughput is also given relative to the MAC array.
+        """
+        rows = [('#', 'layer', 'calls', 'ms', 'out shape', 'dtype', 'MMACs', 'interm. MB', 'GOP/s')
+                + (('% accel',) if peak_gops else ())]
+        for entry in self.summary():
+            row = (str(entry['layer']), entry['name'], str(entry['calls']),
+                   '{:.3f}'.format(entry['seconds'] * 1e3), 'x'.join(map(str, entry['out_shape'])),
+                   entry['dtype'], '{:.3f}'.format(entry['macs'] / 1e6),
+                   '{:.3f}'.format(entry['intermediate_bytes'] / 2**20), '{:.3f}'.format(entry['gops']))
+            if peak_gops:
+                row += ('{:.2f}'.format(100 * entry['gops'] / peak_gops),)
+            rows.append(row)
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
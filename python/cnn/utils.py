@@ -1,16 +1,12 @@
 import numpy as np
 import _pickle as cPickle
 import gzip
+import json
 import os
 
 
 def one_hot_encode(y, num_class):
-    m = y.shape[0]
-    onehot = np.zeros((m, num_class), dtype="int32")
-    for i in range(m):
-        idx = y[i]
-        onehot[i][idx] = 1
-    return onehot
+    return np.eye(num_class, dtype="int32")[y]
 
 
 def accuracy(y_true, y_pred):
@@ -22,7 +18,106 @@ def softmax(x):
     return exp_x / np.sum(exp_x, axis=1, keepdims=True)
 
 
-def load_mnist(path, num_training=50000, num_test=10000, cnn=True, one_hot=False):
+def _cache_file(cache_dir, name):
+    return os.path.join(cache_dir, name + '.npy')
+
+
+def _sources_file(cache_dir, names):
+    return os.path.join(cache_dir, names[0].split('_')[0] + '_sources.json')
+
+
+def _source_key(sources):
+    """ Name, size and mtime of every file the cache was decoded from. """
+    key = []
+    for source in sources:
+        stat = os.stat(source)
+        key.append([os.path.basename(source), stat.st_size, stat.st_mtime_ns])
+    return key
+
+
+def _cache_valid(cache_dir, names, sources):
+    """ Cache files exist and were decoded from the sources as they are now. """
+    files = [_cache_file(cache_dir, name) for name in names]
+    if not all(os.path.exists(f) for f in files):
+        return False
+    try:
+        with open(_sources_file(cache_dir, names)) as f:
+            return json.load(f) == _source_key(sources)
+    except (OSError, ValueError):
+        return False
+
+
+def _save_cache(cache_dir, arrays, sources):
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, array in arrays.items():
+        temp = _cache_file(cache_dir, name) + '.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp, _cache_file(cache_dir, name))
+    # Written last, an interrupted save leaves the cache invalid
+    stamp = _sources_file(cache_dir, list(arrays))
+    with open(stamp + '.tmp', 'w') as f:
+        json.dump(_source_key(sources), f)
+    os.replace(stamp + '.tmp', stamp)
+
+
+def _load_cache(cache_dir, names):
+    return [np.load(_cache_file(cache_dir, name), mmap_mode='r') for name in names]
+
+
+MNIST_CACHE = ('mnist_X_train', 'mnist_y_train', 'mnist_X_test', 'mnist_y_test')
+CIFAR10_CACHE = ('cifar10_X_train', 'cifar10_y_train', 'cifar10_X_test', 'cifar10_y_test')
+
+
+def _cifar10_sources(path):
+    return [os.path.join(path, "data_batch_{0}".format(batch)) for batch in range(1, 6)] + \
+        [os.path.join(path, "test_batch")]
+
+
+def cache_mnist(path, cache_dir):
+    """ Decode the gzipped MNIST pickle once into NCHW .npy files. """
+    f = gzip.open(path, 'rb')
+    training_data, validation_data, test_data = cPickle.load(
+        f, encoding='iso-8859-1')
+    f.close()
+    shape = (-1, 1, 28, 28)
+    _save_cache(cache_dir, dict(zip(MNIST_CACHE, (
+        training_data[0].reshape(shape), training_data[1],
+        test_data[0].reshape(shape), test_data[1]))), [path])
+
+
+def cache_cifar10(path, cache_dir):
+    """ Decode the CIFAR-10 batches once into normalised float64 NCHW .npy files. """
+    (X_train, y_train), (X_test, y_test) = load_cifar10(path, num_training=50000, num_test=10000)
+    _save_cache(cache_dir, dict(zip(CIFAR10_CACHE, (X_train, y_train, X_test, y_test))),
+                _cifar10_sources(path))
+
+
+def iterate_batches(X, y, batch_size):
+    """ Fixed-size (X, y) batches. On memory-mapped data only the pages of
+        the current batch are read.
+    """
+    for start in range(0, len(X), batch_size):
+        yield X[start:start + batch_size], y[start:start + batch_size]
+
+
+def load_mnist(path, num_training=50000, num_test=10000, cnn=True, one_hot=False, cache_dir=None):
+    """ With cache_dir the archive is decoded once, later loads memory-map
+        the cached arrays and slice them lazily.
+    """
+    if cache_dir is not None:
+        if not _cache_valid(cache_dir, MNIST_CACHE, [path]):
+            cache_mnist(path, cache_dir)
+        X_train, y_train, X_test, y_test = _load_cache(cache_dir, MNIST_CACHE)
+        if not cnn:
+            X_train = X_train.reshape(X_train.shape[0], -1)
+            X_test = X_test.reshape(X_test.shape[0], -1)
+        y_train, y_test = y_train[:num_training], y_test[:num_test]
+        if one_hot:
+            y_train = one_hot_encode(y_train, 10)
+            y_test = one_hot_encode(y_test, 10)
+        return (X_train[:num_training], y_train), (X_test[:num_test], y_test)
+
     f = gzip.open(path, 'rb')
     training_data, validation_data, test_data = cPickle.load(
         f, encoding='iso-8859-1')
@@ -39,33 +134,39 @@ def load_mnist(path, num_training=50000, num_test=10000, cnn=True, one_hot=False
         y_train = one_hot_encode(y_train, 10)
         y_validation = one_hot_encode(y_validation, 10)
         y_test = one_hot_encode(y_test, 10)
-    X_train, y_train = X_train[range(
-        num_training)], y_train[range(num_training)]
-    X_test, y_test = X_test[range(num_test)], y_test[range(num_test)]
+    X_train, y_train = X_train[:num_training], y_train[:num_training]
+    X_test, y_test = X_test[:num_test], y_test[:num_test]
     return (X_train, y_train), (X_test, y_test)
 
 
-def load_cifar10(path, num_training=1000, num_test=1000):
+def load_cifar10(path, num_training=1000, num_test=1000, cache_dir=None):
+    """ With cache_dir the batches are decoded once, later loads memory-map
+        the cached arrays and slice them lazily.
+    """
+    if cache_dir is not None:
+        if not _cache_valid(cache_dir, CIFAR10_CACHE, _cifar10_sources(path)):
+            cache_cifar10(path, cache_dir)
+        X_train, y_train, X_test, y_test = _load_cache(cache_dir, CIFAR10_CACHE)
+        return (X_train[:num_training], y_train[:num_training]), (X_test[:num_test], y_test[:num_test])
+
     Xs, ys = [], []
     for batch in range(1, 6):
         f = open(os.path.join(path, "data_batch_{0}".format(batch)), 'rb')
         data = cPickle.load(f, encoding='iso-8859-1')
         f.close()
-        X = data["data"].reshape(10000, 3, 32, 32).astype("float64")
+        X = data["data"].reshape(10000, 3, 32, 32)
         y = np.array(data["labels"])
         Xs.append(X)
         ys.append(y)
-    f = open(os.path.join(CIFAR10_PATH, "test_batch"), 'rb')
+    f = open(os.path.join(path, "test_batch"), 'rb')
     data = cPickle.load(f, encoding='iso-8859-1')
     f.close()
     X_train, y_train = np.concatenate(Xs), np.concatenate(ys)
-    X_test = data["data"].reshape(10000, 3, 32, 32).astype("float")
+    X_test = data["data"].reshape(10000, 3, 32, 32)
     y_test = np.array(data["labels"])
-    X_train, y_train = X_train[range(
-        num_training)], y_train[range(num_training)]
-    X_test, y_test = X_test[range(num_test)], y_test[range(num_test)]
-    mean = np.mean(X_train, axis=0)
-    std = np.std(X_train)
+    # Cast only the rows that are returned
+    X_train, y_train = X_train[:num_training].astype("float64"), y_train[:num_training]
+    X_test, y_test = X_test[:num_test].astype("float64"), y_test[:num_test]
     X_train /= 255.0
     X_test /= 255.0
     return (X_train, y_train), (X_test, y_test)
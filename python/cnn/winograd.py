@@ -0,0 +1,59 @@
+import numpy as np
+
+# Winograd F(2x2, 3x3): Y = A^T [ (G g G^T) * (B^T d B) ] A
+# G is scaled by 2 to keep the kernel transform integer, the result is then
+# exactly 4*Y and divided back at the end. B^T and A^T only hold 0/1/-1 and
+# are applied as additions on strided views instead of matrix products.
+G2 = np.array([[2, 0, 0],
+               [1, 1, 1],
+               [1, -1, 1],
+               [0, 0, 2]], dtype=np.int64)
+
+
+def _B_T(d0, d1, d2, d3):
+    return (d0 - d2, d1 + d2, d2 - d1, d1 - d3)
+
+
+def _A_T(m0, m1, m2, m3):
+    return (m0 + m1 + m2, m1 - m2 - m3)
+
+
+def transform_kernels(W):
+    """ Pre-transform (F, C, 3, 3) kernels into the (16, F, C) Winograd domain. """
+    U = np.einsum('ij,fcjk,lk->ilfc', G2, W, G2)
+    return np.ascontiguousarray(U.reshape(16, W.shape[0], W.shape[1]))
+
+
+def winograd_conv3x3(X_padded, U):
+    """ Valid 3x3/S1 convolution of an already padded (N, C, H, W) input.
+        Exact for integer inputs: everything stays integer up to the final
+        division by 4, which has no remainder.
+    """
+    N, C, H, W = X_padded.shape
+    h_out, w_out = H - 2, W - 2
+    t_h, t_w = -(-h_out // 2), -(-w_out // 2)
+
+    # Extend to a whole number of 2x2 output tiles
+    X_padded = np.pad(X_padded, ((0, 0), (0, 0), (0, 2 * t_h + 2 - H), (0, 2 * t_w + 2 - W)),
+                      mode='constant')
+
+    # Input transform: d[j][k] holds element (j, k) of every 4x4 input tile
+    d = [[X_padded[:, :, j:j + 2 * t_h:2, k:k + 2 * t_w:2] for k in range(4)] for j in range(4)]
+    cols = [_B_T(*(d[j][k] for j in range(4))) for k in range(4)]
+    V = np.empty((4, 4, C, N, t_h, t_w), dtype=np.result_type(X_padded, U))
+    for i in range(4):
+        for l, v in enumerate(_B_T(*(cols[k][i] for k in range(4)))):
+            V[i, l] = v.transpose(1, 0, 2, 3)
+
+    # 16 independent (F, C) x (C, tiles) products
+    M = np.matmul(U, V.reshape(16, C, -1)).reshape(4, 4, U.shape[1], N, t_h, t_w)
+
+    out = np.empty((N, M.shape[2], 2 * t_h, 2 * t_w), dtype=M.dtype)
+    for a, s in enumerate(_A_T(M[0], M[1], M[2], M[3])):
+        for b, y in enumerate(_A_T(s[0], s[1], s[2], s[3])):
+            out[:, :, a::2, b::2] = y.transpose(1, 0, 2, 3)
+
+    out = out[:, :, :h_out, :w_out]
+    if np.issubdtype(out.dtype, np.integer):
+        return out // 4
+    return out / 4
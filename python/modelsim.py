@@ -1,5 +1,8 @@
 import contextlib
 import enum
+import fcntl
+import hashlib
+import json
 import os
 import os.path
 import re
@@ -7,6 +10,7 @@ import subprocess
 import tempfile
 
 from collections import namedtuple
+from time import monotonic
 from subprocess import Popen, check_output, STDOUT, DEVNULL
 
 
@@ -14,31 +18,61 @@ __version__ = (0, 1, 1, 'dev')
 
 
 # the heart of the instrumentation: use blocking FIFO pipes to run TCL commands
+#
+# Both directions are framed with a length prefix, so commands and results may contain
+# newlines. A command is sent as "<bytes>\n<command>", a response as
+# "S<bytes>\n<result>" or "E<bytes>\n<error>". Commands are processed in order without
+# waiting for the response to be read, which allows pipelining batches of commands.
+# Breaks (`stop` in a `when`) end the current `run` but do not pause the script.
 SIMULATION_SCRIPT = r'''
+onbreak {resume}
+
 set fifo_posi [open "__py_modelsim_posi.fifo" "r"]
 set fifo_piso [open "__py_modelsim_piso.fifo" "w"]
+fconfigure $fifo_posi -translation binary
+fconfigure $fifo_piso -translation binary
+
+proc receive {fifo} {
+    set length [gets $fifo]
+    if {$length == ""} {
+        return "quit"
+    }
+    return [encoding convertfrom utf-8 [read $fifo $length]]
+}
+
+proc respond {fifo code message} {
+    set data [encoding convertto utf-8 $message]
+    puts -nonewline $fifo "$code[string length $data]\n$data"
+    flush $fifo
+}
 
 puts $fifo_piso "ready"
 flush $fifo_piso
 
-gets $fifo_posi command
+set command [receive $fifo_posi]
 
 while {$command != "quit"} {
-    if {[catch {
-        set result [eval $command]
-        puts $fifo_piso "S:$result"
-        flush $fifo_piso
-    } error ]} {
-        puts $fifo_piso [string map {"\n" " "} "E:$error"]
-        flush $fifo_piso
+    if {[catch {set result [eval $command]} error]} {
+        respond $fifo_piso "E" $error
+    } else {
+        respond $fifo_piso "S" $result
     }
 
-    gets $fifo_posi command
+    set command [receive $fifo_posi]
 }
 
 quit -f
 '''
 
+# bytes of commands written ahead before reading their responses, kept below the pipe
+# capacity so neither side blocks on a full FIFO
+PIPELINE_BYTES = 32768
+
+
+def encode_command(command):
+    data = command.encode()
+    return str(len(data)).encode() + b'\n' + data
+
 
 RelativeTime = namedtuple('RelativeTime', ['value', 'unit'])
 AbsoluteTime = namedtuple('AbsoluteTime', ['value', 'unit'])
@@ -58,6 +92,48 @@ def tcl_escape(value):
     return '{{{}}}'.format(str(value))
 
 
+# simulator time units in nanoseconds
+TIME_UNITS = {'fs': 1e-6, 'ps': 1e-3, 'ns': 1, 'us': 1e3, 'ms': 1e6, 'sec': 1e9, 's': 1e9}
+
+TIME_REGEX = re.compile(r'^\s*(?P<value>\d+)\s*(?P<unit>[a-z]*)\s*$')
+
+
+def parse_time(string, resolution='1ns'):
+    """
+    Parse a simulator time like the value of `$now`, either with a unit or as a count of
+    `resolution` (e.g. `1ps`) steps, into an `AbsoluteTime`.
+    """
+    match = TIME_REGEX.match(string)
+    if match is None:
+        raise Exception('unable to parse simulator time {!r}'.format(string))
+    if match.group('unit'):
+        return AbsoluteTime(int(match.group('value')), match.group('unit'))
+    scale = TIME_REGEX.match(resolution)
+    return AbsoluteTime(int(match.group('value')) * int(scale.group('value') or 1), scale.group('unit'))
+
+
+# design units a VHDL file defines and the ones it refers to
+VHDL_COMMENT_REGEX = re.compile(r'--[^\n]*')
+VHDL_UNIT_REGEX = re.compile(r'^\s*(?:entity|package)\s+(?!body\b)(\w+)\s+is\b', re.I | re.M)
+VHDL_REFERENCE_REGEX = re.compile(
+    r'\bwork\.(\w+)|\bcomponent\s+(\w+)|\bpackage\s+body\s+(\w+)|\barchitecture\s+\w+\s+of\s+(\w+)',
+    re.I)
+
+
+def parse_vhdl_units(text):
+    """
+    Return the design units defined and referenced by a VHDL source as two sets of lower
+    case names. References are `work.<unit>` selections, component declarations, package
+    bodies and architectures of an entity.
+    """
+    text = VHDL_COMMENT_REGEX.sub('', text)
+    defined = {name.lower() for name in VHDL_UNIT_REGEX.findall(text)}
+    referenced = set()
+    for match in VHDL_REFERENCE_REGEX.finditer(text):
+        referenced.add(next(group for group in match.groups() if group).lower())
+    return defined, referenced - defined
+
+
 class Library:
     """
     ModelSim Verilog library with context manager support.
@@ -65,20 +141,47 @@ class Library:
     If the directory argument is omitted a temporary directory is created on entering the
     context. Further the library is initialized and all Verilog files are compiled. When
     leaving the context, all temporary resources are freed.
+
+    With `persistent=True` the library in `directory` is kept across runs. Entering the
+    context then only recompiles files whose content or compile flags changed, plus the
+    files depending on them. The library is held with a shared lock until the context is
+    left, so concurrent runs can share it; only a recompilation takes an exclusive lock.
     """
 
-    def __init__(self, name, *files, directory=None):
+    MANIFEST = '__py_modelsim_manifest.json'
+    LOCK = '__py_modelsim.lock'
+
+    def __init__(self, name, *files, directory=None, persistent=False, flags=()):
+        if persistent and directory is None:
+            raise Exception('persistent library requires a directory')
         self.name = name
         self.directory = directory
         self.files = list(files)
         self.temporary = None
+        self.persistent = persistent
+        self.flags = list(flags)
+        self.lock = None
 
     def __enter__(self):
         if self.directory is None:
             self.temporary = tempfile.TemporaryDirectory()
             self.directory = self.temporary.name
             self.initialize()
-            self.compile()
+            self.compile(*self.flags)
+        elif self.persistent:
+            os.makedirs(str(self.directory), exist_ok=True)
+            self.lock = open(os.path.join(str(self.directory), self.LOCK), 'a')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_SH)
+                if self.outdated():
+                    # flock cannot upgrade atomically, update() checks again under LOCK_EX
+                    fcntl.flock(self.lock, fcntl.LOCK_EX)
+                    self.update()
+                    fcntl.flock(self.lock, fcntl.LOCK_SH)
+            except BaseException:
+                self.lock.close()
+                self.lock = None
+                raise
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
@@ -86,6 +189,96 @@ class Library:
             self.temporary.cleanup()
             self.directory = None
             self.temporary = None
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def outdated(self):
+        """
+        Return whether `update` has anything to do: the library does not exist yet or
+        some file needs to be recompiled.
+        """
+        if not os.path.isdir(os.path.join(str(self.directory), self.name)):
+            return True
+        return bool(self._plan()[2])
+
+    def update(self):
+        """
+        Incrementally compile the library: files whose content hash (including the compile
+        flags) differs from the manifest of the last compilation and all files referring
+        to their design units are recompiled in dependency order. Returns the compiled
+        files, an empty list if the library is up to date.
+        """
+        manifest_name = os.path.join(str(self.directory), self.MANIFEST)
+        if not os.path.isdir(os.path.join(str(self.directory), self.name)):
+            # a manifest without its library is left over, everything is recompiled
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(manifest_name)
+            self.initialize()
+        manifest, entries, order = self._plan()
+        if order:
+            for filename in order:
+                manifest.pop(filename, None)
+            self._write_manifest(manifest_name, manifest)
+            self.compile(*self.flags, files=order)
+            manifest.update((filename, entries[filename]) for filename in order)
+            self._write_manifest(manifest_name, manifest)
+        return order
+
+    def _plan(self):
+        # manifest of the last compilation, the current file entries and the stale files
+        # in compilation order
+        manifest = {}
+        try:
+            with open(os.path.join(str(self.directory), self.MANIFEST)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+
+        entries, defines = {}, {}
+        for filename in map(str, self.files):
+            with open(filename, 'rb') as source:
+                content = source.read()
+            digest = hashlib.sha256(content)
+            digest.update('\0'.join(['vcom', '-2008'] + self.flags).encode())
+            defined, referenced = parse_vhdl_units(content.decode('latin-1'))
+            entries[filename] = {'hash': digest.hexdigest(), 'units': sorted(defined),
+                                 'references': sorted(referenced)}
+            for unit in defined:
+                defines[unit] = filename
+
+        depends = {filename: [defines[unit] for unit in entry['references']
+                              if unit in defines and defines[unit] != filename]
+                   for filename, entry in entries.items()}
+        stale = {filename for filename, entry in entries.items()
+                 if manifest.get(filename, {}).get('hash') != entry['hash']}
+        changed = True
+        while changed:
+            changed = False
+            for filename, dependencies in depends.items():
+                if filename not in stale and stale.intersection(dependencies):
+                    stale.add(filename)
+                    changed = True
+
+        # dependencies first, the given file order otherwise
+        order, done = [], set()
+        def visit(filename, path=()):
+            if filename in done or filename in path:
+                return
+            for dependency in depends[filename]:
+                visit(dependency, path + (filename,))
+            done.add(filename)
+            order.append(filename)
+        for filename in entries:
+            visit(filename)
+        order = [filename for filename in order if filename in stale]
+        return manifest, entries, order
+
+    @staticmethod
+    def _write_manifest(manifest_name, manifest):
+        with open(manifest_name + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(manifest_name + '.tmp', manifest_name)
 
     def initialize(self, *arguments):
         """
@@ -99,26 +292,29 @@ class Library:
         except subprocess.CalledProcessError as error:
             raise Exception('unable to initialize verilog library', error.output)
 
-    def compile(self, *arguments):
+    def compile(self, *arguments, files=None):
         """
-        Compile the Verilog files using the `vlog` command.
+        Compile the Verilog files (or the given subset) using the `vlog` command.
         """
         if self.directory is None:
             raise Exception('unable to explicitly compile temporary library')
         command = ['vcom', '-2008', '-work', self.name] + list(arguments)
-        command += (str(filename) for filename in self.files)
+        command += (str(filename) for filename in (self.files if files is None else files))
         try:
             check_output(command, cwd=str(self.directory), stderr=STDOUT)
         except subprocess.CalledProcessError as error:
             raise Exception('unable to compile verilog files', error.output)
 
-    def simulate(self, toplevel, *arguments, commandline=True, **keywords):
+    def simulate(self, toplevel, *arguments, commandline=True, generics=None, **keywords):
         """
-        Start the simulator with the given toplevel entity using the `vsim` command.
+        Start the simulator with the given toplevel entity using the `vsim` command. The
+        `generics` mapping is passed as `-g` overrides, so a compiled library can be
+        elaborated with any configuration.
         """
         if self.directory is None:
             raise Exception('unable to simulate outside of the library context')
         command = ['vsim'] + list(arguments)
+        command += ('-g{}={}'.format(name, value) for name, value in (generics or {}).items())
         if commandline:
             command.append('-c')
         command.append('{}.{}'.format(self.name, toplevel))
@@ -162,8 +358,13 @@ class Object:
                 raise Exception('unsupported slice types on verilog object')
             if item.step is not None:
                 raise Exception('slice steps are not supported on verilog objects')
-            for offset, number in enumerate(value):
-                self[item.start + offset] = number
+            # one `change` of the whole range instead of one per element; like `examine` the
+            # range is inclusive and keeps its direction, the first value goes to `start`
+            value = list(value)
+            if len(value) != abs(item.stop - item.start) + 1:
+                raise Exception('unable to assign {} values to range {}:{}'.format(
+                    len(value), item.start, item.stop))
+            self.simulator.change(self.path + '({}:{})'.format(item.start, item.stop), value)
         else:
             raise Exception('unsupported key access on verilog object')
 
@@ -279,16 +480,18 @@ class Simulator:
     """
     Python interface to an instrumented ModelSim instance.
     """
-    def __init__(self, library, toplevel, libraries=None):
+    def __init__(self, library, toplevel, libraries=None, generics=None):
         self.library = library
         self.toplevel = toplevel
         self.libraries = libraries or []
+        self.generics = generics or {}
         self.directory = None
         self.running = False
         self.process = None
         self.posi = None
         self.piso = None
         self.time = None
+        self.prefix = None
         # cache for examine results: speedup multiple accesses
         self.examine_cache = {}
 
@@ -310,22 +513,24 @@ class Simulator:
 
         self.directory = self.library.directory
 
-        posi_name = os.path.join(str(self.directory), '__py_modelsim_posi.fifo')
-        piso_name = os.path.join(str(self.directory), '__py_modelsim_piso.fifo')
-        script_name = os.path.join(str(self.directory), '__py_modelsim_script.do')
+        # unique names, runs may share a persistent library directory
+        self.prefix = '__py_modelsim_{}_{}_'.format(os.getpid(), id(self))
+        posi_name = os.path.join(str(self.directory), self.prefix + 'posi.fifo')
+        piso_name = os.path.join(str(self.directory), self.prefix + 'piso.fifo')
+        script_name = os.path.join(str(self.directory), self.prefix + 'script.do')
 
         os.mkfifo(posi_name)
         os.mkfifo(piso_name)
 
         with open(script_name, 'wb') as script:
-            script.write(SIMULATION_SCRIPT.encode())
+            script.write(SIMULATION_SCRIPT.replace('__py_modelsim_', self.prefix).encode())
 
-        arguments = ['-do', '__py_modelsim_script.do'] + list(arguments)
+        arguments = ['-do', self.prefix + 'script.do'] + list(arguments)
         for library in self.libraries:
             arguments.append('-Lf')
             arguments.append(library)
 
-        self.process = self.library.simulate(self.toplevel, *arguments,
+        self.process = self.library.simulate(self.toplevel, *arguments, generics=self.generics,
                                              stdout=stdout, stderr=stderr)
 
         self.posi = open(str(posi_name), 'wb', 0)
@@ -349,28 +554,59 @@ class Simulator:
         Execute the given TCL command by sending it to the simulator. Returns the result
         or raises a `TCLError` if the command failed.
         """
+        return self.execute_many([command])[0]
+
+    def execute_many(self, commands, raise_errors=True):
+        """
+        Execute TCL commands in order, pipelined: commands are written in batches with a
+        single flush and their responses are read afterwards. Returns the list of results.
+        If a command failed, the `TCLError` of the first failure is raised once all
+        responses are read, or put in place of the result with `raise_errors=False`.
+        """
         if not self.running or self.process.returncode is not None:
             raise Exception('unable to execute command: simulator not running')
-        self.posi.write((command + '\n').encode())
-        code, data = self.piso.readline().decode().partition(':')[::2]
-        if code == 'S':
-            return data.strip()
-        else:
-            raise TCLError(command, data)
+        commands = list(commands)
+        results = []
+        start = 0
+        while start < len(commands):
+            batch, size = [], 0
+            for command in commands[start:]:
+                data = encode_command(command)
+                if batch and size + len(data) > PIPELINE_BYTES:
+                    break
+                batch.append(data)
+                size += len(data)
+            self.posi.write(b''.join(batch))
+            for command in commands[start:start + len(batch)]:
+                code, length = self.piso.read(1), int(self.piso.readline())
+                data = self.piso.read(length).decode()
+                results.append(data if code == b'S' else TCLError(command, data))
+            start += len(batch)
+        if raise_errors:
+            for result in results:
+                if isinstance(result, TCLError):
+                    raise result
+        return results
 
     def examine(self, path, cache=True):
         """
         Issue an examine command for the given path. Since we do not log any signals per
         default, time-travel is not supported.
         """
-        if cache and path in self.examine_cache:
-            return self.examine_cache[path]
-        else:
-            command = 'examine {}'.format(tcl_escape(path))
-            result = parse_examine_result(self.execute(command))
-            if cache:
-                self.examine_cache[path] = result
-            return result
+        return self.examine_many([path], cache=cache)[0]
+
+    def examine_many(self, paths, cache=True):
+        """
+        Examine many paths in one pipelined batch, see `examine`. Returns the values in
+        the order of the paths.
+        """
+        paths = list(paths)
+        missing = [path for path in dict.fromkeys(paths) if not (cache and path in self.examine_cache)]
+        commands = ['examine {}'.format(tcl_escape(path)) for path in missing]
+        values = dict(zip(missing, map(parse_examine_result, self.execute_many(commands))))
+        if cache:
+            self.examine_cache.update(values)
+        return [values[path] if path in values else self.examine_cache[path] for path in paths]
 
     def change(self, path, value):
         """
@@ -416,21 +652,67 @@ class Simulator:
         self.time += time
         self.execute('run {}ns'.format(time))
 
+    UNTIL_LABEL = '__py_modelsim_until'
+
+    def run_until(self, condition, step=None, max_step=None, timeout=None, wall_step=1.0):
+        """
+        Run until the `when` condition expression (e.g. `/tb/done == 1`) becomes true. A
+        `when` breakpoint stops the simulation in exactly that time step, which is returned
+        as `AbsoluteTime`.
+
+        Without `step` the simulation is run by `run -all`. With `step` (nanoseconds) it
+        runs in chunks of that length, each a single pipelined round-trip, which makes the
+        wall-clock `timeout` (seconds) effective. With `max_step` the step size adapts: it
+        doubles while a chunk takes less than half of `wall_step` seconds and halves when a
+        chunk takes more than twice as long.
+        """
+        if timeout is not None and step is None:
+            raise Exception('a wall-clock timeout requires a step size')
+        label = self.UNTIL_LABEL
+        self.execute('when -label {0} {1} {{set ::{0} $now; stop}}'.format(label, tcl_escape(condition)))
+        try:
+            started, last = monotonic(), None
+            while True:
+                command = 'run -all' if step is None else 'run {}ns'.format(step)
+                chunk = monotonic()
+                _, hit, now = self.execute_many([
+                    command, 'if {{[info exists ::{0}]}} {{set ::{0}}}'.format(label), 'set now'])
+                chunk = monotonic() - chunk
+                self.examine_cache = {}
+                if hit:
+                    break
+                if step is None or now == last:
+                    raise Exception('simulation ended before {} became true'.format(condition))
+                if timeout is not None and monotonic() - started > timeout:
+                    raise TimeoutError('{} not true after {} s of simulation'.format(condition, timeout))
+                last = now
+                if max_step is not None:
+                    if chunk < wall_step / 2:
+                        step = min(step * 2, max_step)
+                    elif chunk > wall_step * 2:
+                        step = max(step // 2, 1)
+        finally:
+            self.execute_many(['nowhen {}'.format(label), 'unset -nocomplain ::{}'.format(label)],
+                              raise_errors=False)
+        completed = parse_time(hit, self.execute('set resolution'))
+        self.time = int(completed.value * TIME_UNITS.get(completed.unit, 1))
+        return completed
+
     def cleanup(self):
         """
         Remove FIFO pipes and the TCL script.
         """
-        os.unlink(os.path.join(self.directory, '__py_modelsim_posi.fifo'))
-        os.unlink(os.path.join(self.directory, '__py_modelsim_piso.fifo'))
+        os.unlink(os.path.join(self.directory, self.prefix + 'posi.fifo'))
+        os.unlink(os.path.join(self.directory, self.prefix + 'piso.fifo'))
 
-        os.unlink(os.path.join(self.directory, '__py_modelsim_script.do'))
+        os.unlink(os.path.join(self.directory, self.prefix + 'script.do'))
 
     def quit(self):
         """
         Quit the simulation and wait until it has terminated, cleanup afterwards.
         """
         try:
-            self.posi.write('quit\n'.encode())
+            self.posi.write(encode_command('quit'))
             self.process.wait()
         finally:
             self.cleanup()
@@ -467,17 +749,20 @@ class Simulator:
 
 
 @contextlib.contextmanager
-def simulate(toplevel, *files, libraries=None):
+def simulate(toplevel, *files, libraries=None, generics=None, directory=None):
     """
-    Context manager for easy usage of the simulator.
+    Context manager for easy usage of the simulator. With a directory the compiled library
+    is kept there and only recompiled where the sources changed.
     """
-    library = Library('simulation')
+    library = Library('simulation', directory=directory, persistent=directory is not None)
     library.files.extend(files)
     with library:
-        simulator = Simulator(library, toplevel, libraries)
+        simulator = Simulator(library, toplevel, libraries, generics)
         simulator.start()
-        yield simulator
-        simulator.quit()
+        try:
+            yield simulator
+        finally:
+            simulator.quit()
 
 
 def interactive(toplevel, *files, namespace=None, libraries=None, **keywords):
@@ -1,36 +1,131 @@
+import os
 import re
 import math
+import tempfile
+from contextlib import contextmanager
+
+# Testbench line declaring a constant, the name is the index key
+CONSTANT = re.compile(r'constant (\w+)')
+
+# VHDL bit string literal as handed to set_opMode/set_ConvType, e.g. x"0002"
+BIT_STRING = re.compile(r'^([bBxXoO]?)"([0-9a-fA-F_]*)"$')
+
+
+def vsim_value(value):
+    """ Generic value as vsim -g expects it: integers as is, bit string
+        literals as a quoted binary string ("0010", x"0002" -> "0000000000000010").
+    """
+    match = BIT_STRING.match(str(value).strip())
+    if match is None:
+        return str(value)
+    base, digits = match.group(1).lower(), match.group(2).replace('_', '')
+    bits = {'x': 4, 'o': 3}.get(base, 1)
+    if bits == 1:
+        return '"{}"'.format(digits)
+    return '"{}"'.format(bin(int(digits, 16 if bits == 4 else 8))[2:].zfill(len(digits) * bits))
 
 class ProcessingSystem:
     
     def __init__(self, tb_path):
         self.accel_testbench_path = tb_path
+        # Parsed testbench: lines, constant name -> line numbers, stat at parse
+        self.lines = None
+        self.constants = {}
+        self.stat = None
+        self.dirty = False
+        self.depth = 0
+        # Values of all setters, passed to vsim as generic overrides
+        self.generics = {}
 
     def initialize(self, xpar=3, ypar=3, fpar=3, outbufs=3, data_wdt=16, dramdepth=256, kernelsize=9, weight_wdt=16, kramdepth=128):
-        self.set_Xparallelsim(xpar)
-        self.set_Yparallelsim(ypar)
-        self.set_Fparallelsim(fpar)
-        self.set_NumOutBuffers(outbufs)
-        self.set_DataWidth(data_wdt)
-        self.set_DataRamDepth(dramdepth)      
-        self.set_KernelSize(kernelsize)
-        self.set_WeightWidth(weight_wdt)
-        self.set_KernelRamDepth(kramdepth)     
+        with self.transaction():
+            self.set_Xparallelsim(xpar)
+            self.set_Yparallelsim(ypar)
+            self.set_Fparallelsim(fpar)
+            self.set_NumOutBuffers(outbufs)
+            self.set_DataWidth(data_wdt)
+            self.set_DataRamDepth(dramdepth)
+            self.set_KernelSize(kernelsize)
+            self.set_WeightWidth(weight_wdt)
+            self.set_KernelRamDepth(kramdepth)
+
+    @contextmanager
+    def transaction(self):
+        """ Batch setters: the testbench is parsed once, updated in memory and
+            written once when the outermost transaction ends, atomically and
+            only if a value changed. An unchanged file keeps its mtime.
+            On an exception the pending changes are dropped.
+        """
+        if self.depth == 0:
+            self._load()
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0 and self.dirty:
+                self.stat, self.dirty = None, False
+            raise
+        self.depth -= 1
+        if self.depth == 0 and self.dirty:
+            self._store()
+
+    def _load(self):
+        stat = os.stat(self.accel_testbench_path)
+        if self.stat is not None and (stat.st_mtime_ns, stat.st_size) == self.stat:
+            return
+        with open(self.accel_testbench_path, 'r') as tb:
+            self.lines = tb.readlines()
+        self.constants = {}
+        for number, line in enumerate(self.lines):
+            match = CONSTANT.search(line)
+            if match:
+                self.constants.setdefault(match.group(1), []).append(number)
+        self.stat = (stat.st_mtime_ns, stat.st_size)
+
+    def _store(self):
+        folder = os.path.dirname(os.path.abspath(self.accel_testbench_path))
+        with tempfile.NamedTemporaryFile('w', dir=folder, suffix='.tmp', delete=False) as new_file:
+            new_file.writelines(self.lines)
+        try:
+            os.chmod(new_file.name, os.stat(self.accel_testbench_path).st_mode)
+            os.replace(new_file.name, self.accel_testbench_path)
+        except OSError:
+            os.unlink(new_file.name)
+            raise
+        stat = os.stat(self.accel_testbench_path)
+        self.stat, self.dirty = (stat.st_mtime_ns, stat.st_size), False
+
+    def get_generic(self, generic):
+        """ Current value of a testbench constant as written, None if absent. """
+        with self.transaction():
+            for number in self.constants.get(generic, []):
+                return self.lines[number].split(':=')[-1].strip().rstrip(';').strip()
+
+    def vsim_generics(self):
+        """ Setter values as {name: value} for Library.simulate(generics=...). """
+        return {name: vsim_value(value) for name, value in self.generics.items()}
+
+    def write_do(self, path, toplevel='accelerator_tb', library='work'):
+        """ Write a ModelSim do file starting toplevel with the generic
+            overrides, for runs started by hand (do <path>).
+        """
+        arguments = ' '.join('-g{}={}'.format(name, value) for name, value in self.vsim_generics().items())
+        with open(path, 'w') as do:
+            do.write('vsim {} {}.{}\n'.format(arguments, library, toplevel))
 
     def set_generic(self, generic, value):
-        buffer = []
-        with open(self.accel_testbench_path, 'r') as tb:
-            for line in tb:
-                temp = line
-                if 'constant ' + generic in line:
-                    temp = line.strip().split(':=')
-                    temp[-1] = value
-                    temp = '    ' + temp[0] + ":= " + str(value) + "; \n"
-                buffer.append(temp)
-        
-        with open(self.accel_testbench_path,'w') as new_file:
-            for line in buffer:
-                new_file.write(line)
+        """ Record value as vsim generic override. Testbenches still declaring
+            it as a constant get the source line rewritten as well.
+        """
+        self.generics[generic] = value
+        with self.transaction():
+            for number in self.constants.get(generic, []):
+                temp = self.lines[number].strip().split(':=')
+                temp = '    ' + temp[0] + ":= " + str(value) + "; \n"
+                if temp != self.lines[number]:
+                    self.lines[number] = temp
+                    self.dirty = True
 
     # Set generics needed at synth time
     # Parallelism
@@ -1,3 +1,5 @@
+import os
+import tempfile
 from cnn.utils import load_mnist, load_cifar10
 from cnn.layers import *
 from cnn.nnet import CNN
@@ -50,6 +52,8 @@ DATA_BRAM_PATH = '../vhdl/src/simulation/input/bram.txt'
 KERNEL_BRAM_PATH = "/home/symm3try/neuralnet_accel/MPE_Accel/vhdl/src/simulation/input/kernels.txt"
 OUTPUT_PREFIX_PATH = '../vhdl/src/simulation/output/'
 IN_BUFFER = ["./bramtool/car.jpg"]
+# Compiled work library kept between runs, only changed sources are recompiled
+LIBRARY_PATH = os.path.join(tempfile.gettempdir(), 'accelerator_tb_library')
 # IN_BUFFER = ["input1.txt"]
 # IN_BUFFER = ["input0.txt", "input1.txt"]
 # OPMODE
@@ -91,53 +95,56 @@ out_reader = outreader.OutputReader(X_PARALLELISM, Y_PARALLELISM, F_PARALLELISM,
 
 
 ps = ProcessingSystem("/home/symm3try/neuralnet_accel/MPE_Accel/vhdl/src/simulation/testbenches/accelerator_tb.vhd")
-ps.initialize(  xpar=X_PARALLELISM, ypar=Y_PARALLELISM, fpar=F_PARALLELISM, outbufs=NUM_OUTPUT_BUFFERS, 
-                data_wdt=DATA_WIDTH, dramdepth=DATA_RAM_DEPTH, kernelsize=int(math.pow(KERNEL_DIM,2)), 
-                weight_wdt=WEIGHT_WIDTH, kramdepth=WEIGHT_RAM_DEPTH)
-
-# Setup Runtime Registers on the PL by the PS
-# OpMode                 
-ps.set_opMode(OPMODE)
-# Input dimensions and padding
-ps.set_Xdim(X_DIM)
-ps.set_Ydim(Y_DIM)
-ps.set_PaddingWidth(2)
-# Set number of input fmaps and iterations
-ps.set_NumInFmaps(IN_FMAPS)
-ps.set_TileIterations(TILE_ITERATIONS)
-# FC layer conf
-ps.set_fclFlatdim(FC_DATA_FLATDIM)
-ps.set_fclDataBufNumLines(FC_DATA_TILE_NUMLINES)
-ps.set_fclKernelBufNumLines(FC_KERNELS_TILE_NUMLINES)
+# Configure the testbench in one pass, it is only rewritten if a value changed
+with ps.transaction():
+    ps.initialize(  xpar=X_PARALLELISM, ypar=Y_PARALLELISM, fpar=F_PARALLELISM, outbufs=NUM_OUTPUT_BUFFERS, 
+                    data_wdt=DATA_WIDTH, dramdepth=DATA_RAM_DEPTH, kernelsize=int(math.pow(KERNEL_DIM,2)), 
+                    weight_wdt=WEIGHT_WIDTH, kramdepth=WEIGHT_RAM_DEPTH)
+
+    # Setup Runtime Registers on the PL by the PS
+    # OpMode                 
+    ps.set_opMode(OPMODE)
+    # Input dimensions
+    ps.set_Xdim(X_DIM)
+    ps.set_Ydim(Y_DIM)
+    # Set number of input fmaps and iterations
+    ps.set_NumInFmaps(IN_FMAPS)
+    ps.set_TileIterations(TILE_ITERATIONS)
+    # FC layer conf
+    ps.set_fclFlatdim(FC_DATA_FLATDIM)
+    ps.set_fclDataBufNumLines(FC_DATA_TILE_NUMLINES)
+    ps.set_fclKernelBufNumLines(FC_KERNELS_TILE_NUMLINES)
 
 # --------------------------------------
 # Prepare Input BRAM and Kernel Data
 # --------------------------------------
+# Integer reference matching the accelerator datapath
+fixed = FixedPoint(DATA_WIDTH, WEIGHT_WIDTH)
 cnn_layers = []
 
 if OPMODE == "\"000\"" or OPMODE == "\"100\"": # Conv
-    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=1, padding=1)
+    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=1, padding=1, fixed=fixed)
     cnn_layers.append(conv)
     if OPMODE == "\"100\"":
-        cnn_layers.append(ReLU())
+        cnn_layers.append(ReLU(fixed=fixed))
     conv_fgen.write_conv_kernels(conv.W)
     conv_fgen.convert(inputs[0], kernel_size=3, stride=1, padding_size=1, itype='array', otype='hex')
 elif OPMODE == "\"001\"" or  OPMODE == "\"101\"": # Conv + Pool
-    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=1, padding=1)
+    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=1, padding=1, fixed=fixed)
     pool = Maxpool(conv.out_dim, size=2, stride=2)
     cnn_layers.append(conv)
     if OPMODE == "\"101\"":
-        cnn_layers.append(ReLU())    
+        cnn_layers.append(ReLU(fixed=fixed))    
     cnn_layers.append(pool)
     conv_fgen.write_conv_kernels(conv.W)
     conv_fgen.convert(inputs[0], kernel_size=3, stride=1, padding_size=1, itype='array', otype='hex')
 else: #FC layer
     flat = Flatten()
-    fc = FullyConnected(FC_DATA_FLATDIM, NUM_FILTERS)
+    fc = FullyConnected(FC_DATA_FLATDIM, NUM_FILTERS, fixed=fixed)
     cnn_layers.append(flat)
     cnn_layers.append(fc)
     if OPMODE == "\"110\"":
-        cnn_layers.append(ReLU())  
+        cnn_layers.append(ReLU(fixed=fixed))  
     fc_fgen.convert(inputs, FC_DATA_FLATDIM, FC_DATA_TILE_NUMLINES)
     fc_fgen.write_fc_kernels(kernels=fc.W, num_kernels=NUM_FILTERS, kernel_lines=FC_KERNELS_TILE_NUMLINES, kernel_dim=KERNEL_DIM)
 
@@ -145,13 +152,10 @@ cnn = CNN(cnn_layers)
 result_numpy = cnn.forward(inputs)
 
 print("Start")
-with simulate("accelerator_tb", *files) as simulator:
-    flag = 0
-    while not flag:
-        print("IterX: ")
-        print(simulator.examine('accelerator_tb/accel/core/conv/ctrl/iX'))
-        simulator.run(100000)
-        flag = simulator.examine('/accelerator_tb/test_completed_s')
+with simulate("accelerator_tb", *files, generics=ps.vsim_generics(), directory=LIBRARY_PATH) as simulator:
+    # Stops in the time step the accelerator signals completion
+    completed = simulator.run_until('/accelerator_tb/test_completed_s == 1', step=100000, max_step=10000000)
+    print("Completed at {} {}".format(*completed))
 
 result_sim = None 
 if OPMODE == "\"000\"" or OPMODE == "\"100\"":
@@ -1,4 +1,5 @@
 import numpy as np
+import os
 from ps import *
 from bramtool import convflowgen
 from bramtool import fcflowgen
@@ -14,6 +15,7 @@ from cnn.nnet import CNN
 DATA_BRAM_PATH = '../vhdl/src/simulation/input/bram.txt'
 KERNEL_BRAM_PATH = "../vhdl/src/simulation/input/kernels.txt"
 OUTPUT_PREFIX_PATH = '../vhdl/src/simulation/output/'
+SIMULATE_DO_PATH = '../vhdl/src/simulation/simulate.do'
 
 # OPMODE
 # Mode of operation:
@@ -81,69 +83,74 @@ out_reader = outreader.OutputReader(X_PARALLELISM, Y_PARALLELISM, F_PARALLELISM,
 
 
 ps = ProcessingSystem("../vhdl/src/simulation/testbenches/accelerator_tb.vhd")
-ps.initialize(  xpar=X_PARALLELISM, ypar=Y_PARALLELISM, fpar=F_PARALLELISM, outbufs=NUM_OUTPUT_BUFFERS, 
-                data_wdt=DATA_WIDTH, dramdepth=DATA_RAM_DEPTH, kernelsize=int(math.pow(KERNEL_DIM,2)), 
-                weight_wdt=WEIGHT_WIDTH, kramdepth=WEIGHT_RAM_DEPTH)
-
-# Setup Runtime Registers on the PL by the PS
-# OpMode                 
-ps.set_opMode(OPMODE)
-ps.set_ConvType(CONV_TYPE)
-
-# Input dimensions and padding
-ps.set_Xdim(X_DIM)
-ps.set_Ydim(Y_DIM)
-ps.set_PaddingWidth(2)
-# Set number of input fmaps and iterations
-ps.set_NumInFmaps(IN_FMAPS)
-ps.set_TileIterations(TILE_ITERATIONS)
-# FC layer conf
-ps.set_fclFlatdim(FC_DATA_FLATDIM)
-ps.set_fclDataBufNumLines(FC_DATA_TILE_NUMLINES)
-ps.set_fclKernelBufNumLines(FC_KERNELS_TILE_NUMLINES)
-# Dataflow parameters
-ps.set_NumConvblockBuflines(NUM_CONVBLOCK_BUFLINES)
-ps.set_InFmapBuflines(NUM_IN_FMAP_BUFLINES)
-
-# Dataflow parameters
-ps.set_batchNormAlpha(BATCHNORM_ALPHA)
-ps.set_batchNormBeta(BATCHNORM_BETA)
-
-print("--- Configuration completed! ")
+# Configure the testbench in one pass, it is only rewritten if a value changed
+with ps.transaction():
+    ps.initialize(  xpar=X_PARALLELISM, ypar=Y_PARALLELISM, fpar=F_PARALLELISM, outbufs=NUM_OUTPUT_BUFFERS, 
+                    data_wdt=DATA_WIDTH, dramdepth=DATA_RAM_DEPTH, kernelsize=int(math.pow(KERNEL_DIM,2)), 
+                    weight_wdt=WEIGHT_WIDTH, kramdepth=WEIGHT_RAM_DEPTH)
+
+    # Setup Runtime Registers on the PL by the PS
+    # OpMode                 
+    ps.set_opMode(OPMODE)
+    ps.set_ConvType(CONV_TYPE)
+
+    # Input dimensions
+    ps.set_Xdim(X_DIM)
+    ps.set_Ydim(Y_DIM)
+    # Set number of input fmaps and iterations
+    ps.set_NumInFmaps(IN_FMAPS)
+    ps.set_TileIterations(TILE_ITERATIONS)
+    # FC layer conf
+    ps.set_fclFlatdim(FC_DATA_FLATDIM)
+    ps.set_fclDataBufNumLines(FC_DATA_TILE_NUMLINES)
+    ps.set_fclKernelBufNumLines(FC_KERNELS_TILE_NUMLINES)
+    # Dataflow parameters
+    ps.set_NumConvblockBuflines(NUM_CONVBLOCK_BUFLINES)
+    ps.set_InFmapBuflines(NUM_IN_FMAP_BUFLINES)
+
+    # Dataflow parameters
+    ps.set_batchNormAlpha(BATCHNORM_ALPHA)
+    ps.set_batchNormBeta(BATCHNORM_BETA)
+
+# The configuration goes to vsim as generic overrides, the compiled work library is reused
+ps.write_do(SIMULATE_DO_PATH)
+print("--- Configuration completed! Start the simulation with: do " + os.path.abspath(SIMULATE_DO_PATH))
 
 # --------------------------------------
 # Prepare Input BRAM and Kernel Data
 # --------------------------------------
+# Integer reference matching the accelerator datapath
+fixed = FixedPoint(DATA_WIDTH, WEIGHT_WIDTH)
 cnn_layers = []
 if OPMODE[3] == '1': 
     #FC layer
     flat = Flatten()
-    fc = FullyConnected(FC_DATA_FLATDIM, NUM_FILTERS)
+    fc = FullyConnected(FC_DATA_FLATDIM, NUM_FILTERS, fixed=fixed)
     cnn_layers.append(flat)
     cnn_layers.append(fc)
     if OPMODE[2] == '1':
-        cnn_layers.append(ReLU())    
+        cnn_layers.append(ReLU(fixed=fixed))    
     fc_fgen.convert(inputs, FC_DATA_FLATDIM, FC_DATA_TILE_NUMLINES)
     fc_fgen.write_fc_kernels(kernels=fc.W, num_kernels=NUM_FILTERS, kernel_flatdim=FC_KERNELS_TILE_NUMLINES)
 elif OPMODE[4] == '0': 
     #Convolution
-    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=STRIDE, padding=PADDING)
+    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=STRIDE, padding=PADDING, fixed=fixed)
     cnn_layers.append(conv)
     if OPMODE[2] == '1':
-        cnn_layers.append(ReLU())  
+        cnn_layers.append(ReLU(fixed=fixed))  
     if OPMODE[1] == '1':
-        cnn_layers.append(Batchnorm((NUM_FILTERS, IN_FMAPS, Y_DIM, X_DIM), BATCHNORM_ALPHA, BATCHNORM_BETA))                 
+        cnn_layers.append(Batchnorm((NUM_FILTERS, IN_FMAPS, Y_DIM, X_DIM), BATCHNORM_ALPHA, BATCHNORM_BETA, fixed=fixed))                 
     conv_fgen.write_conv_kernels(conv.W)
     conv_fgen.convert(inputs[0], kernel_size=KERNEL_DIM, stride=STRIDE, padding_size=PADDING, itype='array', otype='hex')
 elif OPMODE[4] == '1':
     #Convolution + pooling
-    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=STRIDE, padding=PADDING)
+    conv = Conv((IN_FMAPS, Y_DIM, X_DIM), n_filter=NUM_FILTERS, h_filter=KERNEL_DIM, w_filter=KERNEL_DIM, stride=STRIDE, padding=PADDING, fixed=fixed)
     pool = Maxpool(conv.out_dim, size=2, stride=2)
     cnn_layers.append(conv)
     if OPMODE[2] == '1':
-        cnn_layers.append(ReLU())    
+        cnn_layers.append(ReLU(fixed=fixed))    
     if OPMODE[1] == '1':
-        cnn_layers.append(Batchnorm((NUM_FILTERS, IN_FMAPS, Y_DIM, X_DIM), BATCHNORM_ALPHA, BATCHNORM_BETA))        
+        cnn_layers.append(Batchnorm((NUM_FILTERS, IN_FMAPS, Y_DIM, X_DIM), BATCHNORM_ALPHA, BATCHNORM_BETA, fixed=fixed))        
     cnn_layers.append(pool)
     conv_fgen.write_conv_kernels(conv.W)
     conv_fgen.convert(inputs[0], kernel_size=KERNEL_DIM, stride=STRIDE, padding_size=PADDING, itype='array', otype='hex')
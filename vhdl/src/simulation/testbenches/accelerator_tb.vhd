@@ -5,25 +5,67 @@ use STD.textio.all;
 use ieee.std_logic_textio.all;
 
 entity accelerator_tb is
+	-- Defaults of a standalone run. ProcessingSystem passes the layer
+	-- configuration as vsim -g overrides, the compiled library is reused.
+	generic(
+		----------------------------------------------------
+		--- Generics specified at synthesis time
+		----------------------------------------------------
+		-- Parallelism
+		Xparallelism : integer := 32;
+		Yparallelism : integer := 16;
+		Fparallelism : integer := 32;
+
+		OutputBuffers  : integer := 32;
+		DataWidth      : integer := 32;
+		DataRamDepth   : integer := 1024;
+		-- Kernel Buffers
+		KernelSize     : integer := 9;
+		WeightWidth    : integer := 8;
+		KernelRamDepth : integer := 1024;
+
+		----------------------------------------------------
+		--- Registers to be set by Processing System
+		----------------------------------------------------
+		-- Mode of operation:
+		-- **00 - convolution
+		-- **01 - convolution + pooling
+		-- **10 - fclayer
+		-- *1** - ReLU active
+		-- 1*** - BatchNormalization active
+		opMode : std_logic_vector(3 downto 0) := "0010";
+
+		-- ConvType:
+		-- x"0001" - 1x1, Padding 0,
+		-- x"0002" - 3x3, Padding 1,
+		ConvType : std_logic_vector(15 downto 0) := x"0002";
+
+		-- Input Dimensions
+		X_Dim                : integer := 64;
+		Y_Dim                : integer := 64;
+		-- Convblock properties
+		NumConvblockBuflines : integer := 4;
+
+		-- Number of input Fmaps to calculate for
+		NumInputFmaps  : integer := 2;
+		InFmapBuflines : integer := 64;
+
+		-- Number Tiles to process at one runthrough
+		TileIterations : integer := 1;
+
+		-- Information needed for FC layer
+		fcl_flatdim            : integer := 1024;
+		fcl_data_bufnumlines   : integer := 2;
+		fcl_kernel_bufnumlines : integer := 1024;
+
+		-- Batchnorm Parameters
+		batchNorm_Alpha : integer := 2;
+		batchNorm_Beta  : integer := -4
+	);
 end entity;
 
 architecture simulate OF accelerator_tb is
 
-	----------------------------------------------------
-	--- Generics specified at synthesis time
-	----------------------------------------------------
-	-- Parallelism
-    constant Xparallelism : integer := 32; 
-    constant Yparallelism : integer := 16; 
-    constant Fparallelism : integer := 32; 
-
-    constant OutputBuffers  : integer := 32; 
-    constant DataWidth      : integer := 32; 
-    constant DataRamDepth   : integer := 1024; 
-	-- Kernel Buffers
-    constant KernelSize     : integer := 9; 
-    constant WeightWidth    : integer := 8; 
-    constant KernelRamDepth : integer := 1024; 
 	-- P2S to Outputbuf MUXes
 	constant MuxInputWidth  : integer := (Fparallelism / OutputBuffers) * Yparallelism * Xparallelism * DataWidth;
 	constant MuxOutputWidth : integer := Xparallelism * DataWidth;
@@ -32,50 +74,14 @@ architecture simulate OF accelerator_tb is
 	constant KernelBramAddrWidth : integer := 32;
 	constant OutputBramAddrWidth : integer := 32;
 
-	----------------------------------------------------
-	--- Registers to be set by Processing System
-	----------------------------------------------------
-	-- Mode of operation:
-	-- **00 - convolution
-	-- **01 - convolution + pooling
-	-- **10 - fclayer
-	-- *1** - ReLU active
-	-- 1*** - BatchNormalization active
-
-    constant opMode : std_logic_vector(3 downto 0) := "0010"; 
-
-	-- ConvType:
-	-- x"0001" - 1x1, Padding 0,
-	-- x"0002" - 3x3, Padding 1, 
-    constant ConvType : std_logic_vector(15 downto 0) := x"0002"; 
-
-	-- Input Dimensions and Metainfo implied by dimensionality
-    constant X_Dim                : integer := 64; 
-    constant Y_Dim                : integer := 64; 
+	-- Metainfo implied by dimensionality
 	constant X_NumBlocks          : integer := X_Dim / Xparallelism;
 	constant Y_NumBlocks          : integer := Y_Dim / Yparallelism;
-	-- Convblock properties
-    constant NumConvblockBuflines : integer := 4; 
 
-	-- Number of I/O Fmaps to calculate for
+	-- Number of output Fmaps to calculate for
 	constant NumOutputFmaps : integer := Fparallelism / OutputBuffers;
-    constant NumInputFmaps  : integer := 2; 
-
-    constant InFmapBuflines  : integer := 64; 
 	constant OutFmapBuflines : integer := X_NumBlocks * Y_NumBlocks * Yparallelism * NumOutputFmaps;
 
-	-- Number Tiles to process at one runthrough
-    constant TileIterations : integer := 1; 
-
-	-- Information needed for FC layer
-    constant fcl_flatdim            : integer := 1024; 
-    constant fcl_data_bufnumlines   : integer := 2; 
-    constant fcl_kernel_bufnumlines : integer := 1024; 
-
-	-- Batchnorm Parameters
-    constant batchNorm_Alpha : integer := 2; 
-    constant batchNorm_Beta  : integer := -4; 
-
 	----------------------------------------------------
 	--- Simulation constants
 	----------------------------------------------------